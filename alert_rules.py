@@ -0,0 +1,114 @@
+import numpy as np
+
+STEP_SECONDS = 3 * 60 * 60  # duration of a forecast time step
+RAIN_GROUPS = (2, 3, 5)  # weather condition groups of thunderstorm, drizzle and rain, see openweathermap.org
+
+
+class AlertRule:
+    """
+    Threshold rule of the rain alert. A time step matches the rule if all the given thresholds are met,
+    the alert is sent if any step within the window after the alert time matches.
+    """
+    __slots__ = ('min_pop', 'min_rain', 'condition_groups', 'window_hours')
+
+    def __init__(self, min_pop=None, min_rain=None, condition_groups=None, window_hours=15):
+        """
+        :param min_pop: (float) minimum probability of precipitation from 0 to 1 (default=None, not checked)
+        :param min_rain: (float) minimum rain volume in mm per time step (default=None, not checked)
+        :param condition_groups: tuple of the weather condition groups (id // 100), e.g. (2, 3, 5)
+         (default=None, not checked)
+        :param window_hours: (float) waking window after the alert time checked by the rule
+        """
+        self.min_pop = min_pop
+        self.min_rain = min_rain
+        self.condition_groups = condition_groups
+        self.window_hours = window_hours
+
+    def __repr__(self):
+        return f"AlertRule({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+    def evaluate(self, columns, now):
+        """
+        Evaluate the rule for all the locations at once
+        :param columns: (ForecastColumns) forecasts of the locations
+        :param now: (int) unix time of the alert
+        :return: (np.ndarray) bool array, True for the locations that need the alert
+        """
+        match = (columns.time_ts + STEP_SECONDS > now) & (columns.time_ts < now + self.window_hours * 3600)
+        if self.min_pop is not None:
+            match &= columns.pop_ts >= self.min_pop
+        if self.min_rain is not None:
+            match &= columns.rain_ts >= self.min_rain
+        if self.condition_groups is not None:
+            match &= np.isin(columns.weather_id_ts // 100, self.condition_groups)
+        return match.any(axis=1)
+
+
+DEFAULT_RULES = (
+    AlertRule(min_pop=0.4, condition_groups=RAIN_GROUPS),
+    AlertRule(min_rain=1.0),
+)
+
+
+class ForecastColumns:
+    """
+    Forecasts of several locations stacked into 2D arrays of shape (n_locations, n_steps).
+    Shorter forecasts are padded with the steps which never match a rule.
+    """
+    __slots__ = ('time_ts', 'pop_ts', 'rain_ts', 'weather_id_ts')
+
+    def __init__(self, forecasts):
+        """
+        :param forecasts: list of Forecast
+        """
+        n_steps = max((len(forecast) for forecast in forecasts), default=0)
+        shape = (len(forecasts), n_steps)
+        self.time_ts = np.full(shape, np.iinfo(np.int64).min // 2, dtype=np.int64)
+        self.pop_ts = np.zeros(shape, dtype=np.float32)
+        self.rain_ts = np.zeros(shape, dtype=np.float32)
+        self.weather_id_ts = np.zeros(shape, dtype=np.int16)
+        for i, forecast in enumerate(forecasts):
+            n = len(forecast)
+            self.time_ts[i, :n] = forecast.time_ts
+            self.pop_ts[i, :n] = forecast.pop_ts
+            self.rain_ts[i, :n] = forecast.rain_ts
+            self.weather_id_ts[i, :n] = forecast.weather_id_ts
+
+
+class AlertEngine:
+    """
+    Vectorized evaluation of the alert rules for a batch of locations
+    """
+    def __init__(self, rules=DEFAULT_RULES):
+        """
+        :param rules: tuple of AlertRule, the alert is sent if any rule matches
+        """
+        self.rules = tuple(rules)
+
+    def evaluate(self, forecasts, now):
+        """
+        Evaluate the rules for the forecasts of the locations
+        :param forecasts: list of Forecast
+        :param now: (int) unix time of the alert
+        :return: (np.ndarray) bool array, True for the locations that need the alert
+        """
+        alert = np.zeros(len(forecasts), dtype=bool)
+        if not forecasts:
+            return alert
+        columns = ForecastColumns(forecasts)
+        for rule in self.rules:
+            alert |= rule.evaluate(columns, now)
+        return alert
+
+    def chat_ids_to_alert(self, chat_locations, forecasts, now):
+        """
+        Select the chats that need the alert
+        :param chat_locations: (dict) {chat_id: location key}
+        :param forecasts: (dict) {location key: Forecast}, chats without the forecast are skipped
+        :param now: (int) unix time of the alert
+        :return: (list) chat ids
+        """
+        keys = list(forecasts)
+        alert = self.evaluate([forecasts[key] for key in keys], now)
+        location_alert = dict(zip(keys, alert.tolist()))
+        return [chat_id for chat_id, key in chat_locations.items() if location_alert.get(key, False)]
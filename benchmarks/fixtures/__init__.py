@@ -0,0 +1,24 @@
+import json
+import os
+
+FIXTURES_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_NAMES = ('forecast_london.json', 'forecast_new_york.json', 'forecast_tokyo.json')
+
+
+def load_fixture_bytes(name):
+    """
+    Return the raw body of the recorded /data/2.5/forecast response
+    :param name: str, file name of the fixture, e.g. 'forecast_london.json'
+    :return: (bytes)
+    """
+    with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+        return f.read()
+
+
+def load_fixture(name):
+    """
+    Return the decoded recorded /data/2.5/forecast response
+    :param name: str, file name of the fixture, e.g. 'forecast_london.json'
+    :return: (dict)
+    """
+    return json.loads(load_fixture_bytes(name))
@@ -0,0 +1,252 @@
+"""
+Load test of the delivery pipeline with many subscribers due in the same minute.
+It runs offline against the in-process stand-ins of openweathermap.org and the Telegram Bot API:
+the subscribers are signed up through UIHandler.start, scheduled through WeatherMailer.make_schedule
+and the due minute is dispatched to WeatherMailer.send_weather_forecast and the rain alerts.
+
+The run fails with the exit status 1 if a subscriber got no report, a message was not delivered
+or the 429 responses, the p99 delivery lag or the upstream calls per subscriber exceed their limits.
+
+Usage: python -m benchmarks.load_test [--subscribers N] [--locations N] [--owm-latency S] [--owm-error-rate R]
+"""
+import argparse
+import asyncio
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+import numpy as np
+from telegram import Bot, Chat, Message, Update, User
+from delivery_queue import DeliveryQueue
+from delivery_scheduler import DeliveryScheduler
+from forecast_cache import ForecastCache
+from gazetteer import Gazetteer
+from icon_atlas import ICON_IDS, ICON_SIZE
+from openweathermap_parser import AsyncOpenweathermapParser
+from render_pool import RenderPool
+from subscriptions import MINUTES_PER_DAY, SubscriptionRegistry, minute_to_time
+from ui_handler import UIHandler
+from weather_mailer import WeatherMailer
+from benchmarks.stand_ins import FakeOpenWeatherMap, FakeTelegramRequest
+
+
+class Context:
+    """Stand-in of the handler context of telegram.ext carrying the user data"""
+    def __init__(self, user_data):
+        self.user_data = user_data
+
+
+class CountingDeliveryQueue(DeliveryQueue):
+    """Delivery queue counting the submitted messages"""
+    submitted = 0
+
+    def submit(self, chat_id, send):
+        self.submitted += 1
+        super().submit(chat_id, send)
+
+
+class ResourceMonitor:
+    """Sample the number of threads of the process"""
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_os_threads = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            self.peak_os_threads = max(self.peak_os_threads, self.os_threads())
+            await asyncio.sleep(self.interval)
+
+    @staticmethod
+    def os_threads():
+        """Return the number of threads of the process including the native ones, 0 if unknown"""
+        try:
+            with open('/proc/self/status') as f:
+                return next(int(line.split()[1]) for line in f if line.startswith('Threads:'))
+        except (OSError, StopIteration):
+            return 0
+
+
+def make_icon_pack(path):
+    """Write a pack of plain round icons, so the render workers do not download the icons"""
+    yy, xx = np.mgrid[:ICON_SIZE, :ICON_SIZE]
+    disc = ((yy - ICON_SIZE / 2) ** 2 + (xx - ICON_SIZE / 2) ** 2 < (ICON_SIZE / 3) ** 2)
+    pack = np.zeros((len(ICON_IDS), ICON_SIZE, ICON_SIZE, 4), dtype=np.uint8)
+    for i in range(len(ICON_IDS)):
+        pack[i][disc] = (255, 200 - 10 * i, 40 + 10 * i, 255)
+    np.save(path, pack)
+
+
+def make_start_update(bot, chat_id):
+    """Return the update of the /start command sent by the user"""
+    user = User(chat_id, f'user{chat_id}', False)
+    message = Message(chat_id, datetime.now(), Chat(chat_id, Chat.PRIVATE), from_user=user, text='/start')
+    message.set_bot(bot)
+    return Update(chat_id, message=message)
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else float('nan')
+
+
+def check(args, results):
+    """
+    Compare the results of the run with the limits
+    :param args: (argparse.Namespace) parsed arguments with the limits
+    :param results: (dict) measured values of the run
+    :return: list of str, descriptions of the failed checks
+    """
+    failures = []
+    if results['reported'] < args.subscribers:
+        failures.append(f"{args.subscribers - results['reported']} subscribers got no report")
+    if results['undelivered']:
+        failures.append(f"{results['undelivered']} messages were not delivered")
+    if results['failed']:
+        failures.append(f"{results['failed']} messages failed")
+    if results['rejected'] > args.max_429:
+        failures.append(f"{results['rejected']} 429 responses, at most {args.max_429} allowed")
+    if not results['p99'] <= args.max_p99:
+        failures.append(f"p99 delivery lag {results['p99']:.2f} s, at most {args.max_p99} s allowed")
+    if results['calls_per_subscriber'] > args.max_calls_per_subscriber:
+        failures.append(f"{results['calls_per_subscriber']:.3f} upstream calls per subscriber, "
+                        f"at most {args.max_calls_per_subscriber} allowed")
+    return failures
+
+
+async def run(args):
+    """
+    Sign up the subscribers, deliver their reports and alerts due in the same minute and print the results
+    :param args: (argparse.Namespace) parsed arguments
+    :return: dict, measured values of the run, see check
+    """
+    owm = FakeOpenWeatherMap(latency=args.owm_latency, error_rate=args.owm_error_rate, seed=args.seed)
+    telegram = FakeTelegramRequest()
+    bot = Bot('123456:load-test', request=telegram, get_updates_request=telegram)
+    await bot.initialize()
+
+    owmparser = AsyncOpenweathermapParser('load-test', calls_per_minute=args.owm_calls_per_minute,
+                                          transport=owm.transport)
+    scheduler = DeliveryScheduler()
+    delivery_queue = CountingDeliveryQueue(spread_window=args.spread_window)
+    render_pool = RenderPool(args.render_workers)
+    mailer = WeatherMailer(owmparser, bot, scheduler, delivery_queue, render_pool, SubscriptionRegistry())
+    ui = UIHandler(owmparser, mailer, Gazetteer(path=None))
+    monitor = ResourceMonitor()
+    monitor.start()
+    render_pool.start()
+    delivery_queue.start()
+
+    # Sign up the subscribers, the signup replies are not limited to keep the setup short
+    rng = random.Random(args.seed)
+    locations = [(round(rng.uniform(-60, 60), 4), round(rng.uniform(-180, 180), 4)) for _ in range(args.locations)]
+    telegram.enforce_limits = False
+    for chat_id in range(1, args.subscribers + 1):
+        lat, lon = locations[chat_id % len(locations)]
+        context = Context({'lat': lat, 'lon': lon, 'city': 'Test', 'country': 'TS'})
+        await ui.start(make_start_update(bot, chat_id), context)
+    # The UTC offsets of the new locations are requested in the background
+    deadline = time.monotonic() + args.timeout
+    while any(owmparser.forecast_cache.get_stale(lat, lon) is None for lat, lon in locations):
+        if time.monotonic() > deadline:
+            break
+        await asyncio.sleep(0.05)
+    signup_calls = owm.calls
+    if args.cold_cache:
+        owmparser.forecast_cache = ForecastCache()
+
+    # The signup replies count in the limits of Telegram for a second, the deliveries are limited without them
+    await asyncio.sleep(1)
+    # Schedule all the reports and alerts to the current minute, not too close to its end
+    if time.time() % 60 > 50:
+        await asyncio.sleep(60 - time.time() % 60)
+    due_minute = int(time.time() // 60) % MINUTES_PER_DAY
+    for subscription in list(mailer.registry):
+        local_minute = (due_minute + subscription.tz_offset // 60) % MINUTES_PER_DAY
+        mailer.make_schedule(subscription.chat_id, minute_to_time(local_minute), minute_to_time(local_minute))
+
+    telegram.enforce_limits = True
+    n_signup_messages = len(telegram.delivered['sendMessage'])
+    started_at = time.time()
+    scheduler.run_pending()
+    await scheduler.join()
+    dispatched_at = time.time()
+    while delivery_queue.sent + delivery_queue.failed < delivery_queue.submitted:
+        if time.time() - started_at > args.timeout:
+            print("Timed out waiting for the deliveries")
+            break
+        await asyncio.sleep(0.1)
+    finished_at = time.time()
+
+    await monitor.stop()
+    await delivery_queue.stop()
+    render_pool.shutdown()
+    await owmparser.aclose()
+
+    deliveries = telegram.delivered['sendPhoto'] + telegram.delivered['sendMessage'][n_signup_messages:]
+    lags = [delivered_at - started_at for _, delivered_at in deliveries]
+    elapsed = (max(delivered_at for _, delivered_at in deliveries) - started_at) if deliveries else float('nan')
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f"Subscribers: {args.subscribers}, locations: {args.locations}")
+    print(f"Delivered: {len(telegram.delivered['sendPhoto'])} reports, "
+          f"{len(telegram.delivered['sendMessage']) - n_signup_messages} alerts, failed {delivery_queue.failed}, "
+          f"429 responses {telegram.rejected}")
+    print(f"Throughput: {len(deliveries) / elapsed:.1f} messages/s over {elapsed:.1f} s "
+          f"(jobs dispatched in {dispatched_at - started_at:.2f} s, spread window {args.spread_window} s)")
+    print(f"Delivery lag: p50 {percentile(lags, 50):.2f} s, p99 {percentile(lags, 99):.2f} s")
+    print(f"Upstream calls per subscriber: {owm.calls / args.subscribers:.3f} "
+          f"(signup {signup_calls}, delivery {owm.calls - signup_calls}, errors {owm.errors})")
+    print(f"Peak RSS: {rss_mb:.0f} MiB, render workers {children_rss_mb:.0f} MiB")
+    print(f"Peak threads: {monitor.peak_threads} Python, {monitor.peak_os_threads} total")
+    print(f"Run time: {finished_at - started_at:.1f} s")
+    return {'reported': len({chat_id for chat_id, _ in telegram.delivered['sendPhoto']}),
+            'undelivered': delivery_queue.submitted - delivery_queue.sent - delivery_queue.failed,
+            'failed': delivery_queue.failed, 'rejected': telegram.rejected, 'p99': percentile(lags, 99),
+            'calls_per_subscriber': owm.calls / args.subscribers}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--subscribers', type=int, default=500, help='number of synthetic subscribers')
+    arg_parser.add_argument('--locations', type=int, default=50, help='number of distinct locations')
+    arg_parser.add_argument('--owm-latency', type=float, default=0.05, help='mean response time, seconds')
+    arg_parser.add_argument('--owm-error-rate', type=float, default=0.0, help='share of 500 responses')
+    arg_parser.add_argument('--owm-calls-per-minute', type=int, default=6000, help='rate limit of the API plan')
+    arg_parser.add_argument('--spread-window', type=float, default=5, help='spread of the deliveries, seconds')
+    arg_parser.add_argument('--render-workers', type=int, default=2, help='number of render processes')
+    arg_parser.add_argument('--cold-cache', action=argparse.BooleanOptionalAction, default=True,
+                            help='drop the forecasts fetched at the signup before the delivery')
+    arg_parser.add_argument('--timeout', type=float, default=300, help='maximum run time, seconds')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--max-429', type=int, default=0, help='allowed number of 429 responses of Telegram')
+    arg_parser.add_argument('--max-p99', type=float, default=60, help='allowed p99 delivery lag, seconds')
+    arg_parser.add_argument('--max-calls-per-subscriber', type=float, default=0.5,
+                            help='allowed number of openweathermap.org calls per subscriber')
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # The render workers are spawned with this environment and load the icons from the pack
+        os.environ['ICON_PACK_PATH'] = os.path.join(tmp_dir, 'icons.npy')
+        make_icon_pack(os.environ['ICON_PACK_PATH'])
+        results = asyncio.run(run(args))
+    failures = check(args, results)
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Measure the parse throughput and the memory allocated by parsing the recorded forecast responses.
+
+Usage: python -m benchmarks.parse_forecast [--repeat N]
+"""
+import argparse
+import json
+import tracemalloc
+from time import perf_counter
+import openweathermap_parser
+from openweathermap_parser import OpenweathermapParser
+from benchmarks.fixtures import FIXTURE_NAMES, load_fixture_bytes
+
+DECODERS = {'json': json.loads}
+try:
+    import orjson
+    DECODERS['orjson'] = orjson.loads
+except ImportError:
+    pass
+
+
+class RecordedResponse:
+    """Response with the recorded body, as returned by requests and httpx"""
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+
+def measure_throughput(responses, repeat):
+    """
+    Return the number of responses parsed per second
+    :param responses: list of RecordedResponse
+    :param repeat: int, number of passes over the responses
+    """
+    start = perf_counter()
+    for _ in range(repeat):
+        for response in responses:
+            OpenweathermapParser.parse_response(response)
+    return repeat * len(responses) / (perf_counter() - start)
+
+
+def measure_peak_memory(response):
+    """
+    Return the peak memory allocated while the response is parsed
+    :return: (int) bytes
+    """
+    tracemalloc.start()
+    start_size, _ = tracemalloc.get_traced_memory()
+    OpenweathermapParser.parse_response(response)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - start_size
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--repeat', type=int, default=1000, help='passes over the fixtures')
+    args = arg_parser.parse_args()
+
+    responses = [RecordedResponse(load_fixture_bytes(name)) for name in FIXTURE_NAMES]
+    default_loads = openweathermap_parser.json_loads
+    try:
+        for decoder, loads in DECODERS.items():
+            openweathermap_parser.json_loads = loads
+            OpenweathermapParser.parse_response(responses[0])  # warm up
+            throughput = measure_throughput(responses, args.repeat)
+            peak = max(measure_peak_memory(response) for response in responses)
+            print(f"{decoder}: {throughput:,.0f} responses/s, peak {peak / 1024:.1f} KiB allocated per response")
+    finally:
+        openweathermap_parser.json_loads = default_loads
+    _, forecast = OpenweathermapParser.parse_response(responses[0])
+    print(f"Response {len(responses[0].content) / 1024:.1f} KiB, parsed forecast {len(forecast.to_bytes())} bytes")
+
+
+if __name__ == '__main__':
+    main()
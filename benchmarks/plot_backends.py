@@ -0,0 +1,77 @@
+"""
+Compare the speed and the output of the plot backends of PlotBuilder.
+The icons are plain discs written to a temporary pack, so the benchmark does not download them.
+
+Usage: python -m benchmarks.plot_backends [--repeat N] [--save-dir DIR]
+"""
+import argparse
+import io
+import os
+import tempfile
+from time import perf_counter
+import numpy as np
+from PIL import Image
+from openweathermap_parser import OpenweathermapParser
+from icon_atlas import icon_atlas
+from plot_weather_graph import BACKENDS, PlotBuilder
+from benchmarks.fixtures import FIXTURE_NAMES, load_fixture
+from benchmarks.load_test import make_icon_pack
+
+
+def time_backend(forecast, backend, repeat):
+    """
+    Return the mean render time of the backend and its last image
+    :return: (tuple) (seconds per image, PNG bytes)
+    """
+    builder = PlotBuilder(forecast, backend)
+    png = builder.render_png()  # warm up the caches
+    start = perf_counter()
+    for _ in range(repeat):
+        png = builder.render_png()
+    return (perf_counter() - start) / repeat, png
+
+
+def pixel_diff(png_a, png_b):
+    """
+    Compare two images, the second one is resized to the size of the first one
+    :return: (tuple) (mean absolute difference of the channels in 0..255, share of pixels differing by more than 64)
+    """
+    img_a = Image.open(io.BytesIO(png_a)).convert('RGB')
+    img_b = Image.open(io.BytesIO(png_b)).convert('RGB').resize(img_a.size, Image.BILINEAR)
+    diff = np.abs(np.asarray(img_a, dtype=np.int16) - np.asarray(img_b, dtype=np.int16))
+    return diff.mean(), (diff.max(axis=2) > 64).mean()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--repeat', type=int, default=20, help='renders per backend and fixture')
+    arg_parser.add_argument('--save-dir', help='directory to save the rendered images to')
+    args = arg_parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        icon_atlas.pack_path = os.path.join(tmp_dir, 'icons.npy')
+        make_icon_pack(icon_atlas.pack_path)
+        compare_backends(args)
+
+
+def compare_backends(args):
+    """Render the fixtures with both backends and print their speed and pixel difference"""
+    speedups = []
+    for name in FIXTURE_NAMES:
+        forecast = OpenweathermapParser.parse_weather_data(load_fixture(name))
+        results = {backend: time_backend(forecast, backend, args.repeat) for backend in BACKENDS}
+        seconds = {backend: result[0] for backend, result in results.items()}
+        speedup = seconds['matplotlib'] / seconds['fast']
+        speedups.append(speedup)
+        mean_diff, differing = pixel_diff(results['fast'][1], results['matplotlib'][1])
+        print(f"{name}: matplotlib {seconds['matplotlib'] * 1e3:.1f} ms, fast {seconds['fast'] * 1e3:.2f} ms, "
+              f"speedup {speedup:.1f}x, mean pixel diff {mean_diff:.1f}/255, differing pixels {differing:.1%}")
+        if args.save_dir:
+            os.makedirs(args.save_dir, exist_ok=True)
+            for backend, (_, png) in results.items():
+                with open(os.path.join(args.save_dir, f"{os.path.splitext(name)[0]}_{backend}.png"), 'wb') as f:
+                    f.write(png)
+    print(f"Geometric mean speedup: {np.exp(np.mean(np.log(speedups))):.1f}x")
+
+
+if __name__ == '__main__':
+    main()
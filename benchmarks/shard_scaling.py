@@ -0,0 +1,99 @@
+"""
+Measure how the delivery throughput scales with the number of delivery shard processes.
+For each number of shards the subscribers are sent through ShardPool with their reports due at the same minute,
+the shards run offline against the in-process stand-ins of openweathermap.org and the Telegram Bot API.
+The limit of the Telegram stand-in is raised, so the shards are limited by the CPU rather than by Telegram.
+
+Usage: python -m benchmarks.shard_scaling [--shards 1 2 4] [--subscribers N] [--locations N]
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from sharding import ShardPool
+from subscriptions import MINUTES_PER_DAY, minute_to_time
+from benchmarks.load_test import make_icon_pack
+from benchmarks.stand_ins import FakeOpenWeatherMap, FakeTelegramRequest
+
+# Settings of the stand-ins read in the shard processes, they inherit the environment
+MESSAGES_PER_SECOND_ENV = 'SHARD_SCALING_MESSAGES_PER_SECOND'
+OWM_LATENCY_ENV = 'SHARD_SCALING_OWM_LATENCY'
+
+
+def make_bot_request():
+    return FakeTelegramRequest(messages_per_second=int(os.environ[MESSAGES_PER_SECOND_ENV]), latency=0.02)
+
+
+def make_owm_transport():
+    return FakeOpenWeatherMap(latency=float(os.environ[OWM_LATENCY_ENV])).transport
+
+
+async def run(n_shards, args, db_path):
+    """Deliver the reports of the subscribers with the shards, return the delivery time and throughput"""
+    pool = ShardPool(n_shards, '123456:shard-scaling', 'shard-scaling', db_path, owm_calls_per_minute=10 ** 6,
+                     make_bot_request=make_bot_request, make_owm_transport=make_owm_transport,
+                     render_workers=args.render_workers, spread_window=0, messages_per_second=args.telegram_rate)
+    pool.start()
+    try:
+        # The shards read the commands once their pipeline is started
+        while len(await pool.stats(timeout=60)) < n_shards:
+            pass
+
+        # The reports are due at the start of the next minute at least 20 s ahead
+        due_at = (int(time.time()) // 60 + 1) * 60
+        if due_at - time.time() < 20:
+            due_at += 60
+        due_minute = due_at // 60 % MINUTES_PER_DAY
+        owm = FakeOpenWeatherMap()
+        rng = random.Random(args.seed)
+        locations = [(round(rng.uniform(-60, 60), 4), round(rng.uniform(-180, 180), 4))
+                     for _ in range(args.locations)]
+        for chat_id in range(1, args.subscribers + 1):
+            lat, lon = locations[chat_id % len(locations)]
+            tz_offset = owm.timezone(lat, lon)
+            local_minute = (due_minute + tz_offset // 60) % MINUTES_PER_DAY
+            # The alerts are due half a day later, only the reports are measured
+            pool.subscribe(chat_id, lat, lon, minute_to_time(local_minute),
+                           minute_to_time((local_minute + MINUTES_PER_DAY // 2) % MINUTES_PER_DAY))
+        await asyncio.sleep(max(0.0, due_at - time.time()))
+
+        done = 0
+        while done < args.subscribers and time.time() - due_at < args.timeout:
+            await asyncio.sleep(0.2)
+            stats = await pool.stats()
+            done = sum(shard['sent'] + shard['failed'] for shard in stats)
+        elapsed = time.time() - due_at
+        sent = sum(shard['sent'] for shard in stats)
+        return {'shards': n_shards, 'sent': sent, 'elapsed': elapsed, 'per_shard': [s['sent'] for s in stats]}
+    finally:
+        await pool.stop()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4], help='numbers of shards to run')
+    arg_parser.add_argument('--subscribers', type=int, default=2000, help='number of synthetic subscribers')
+    arg_parser.add_argument('--locations', type=int, default=200, help='number of distinct locations')
+    arg_parser.add_argument('--render-workers', type=int, default=None,
+                            help='render processes of each shard (default=cores / shards)')
+    arg_parser.add_argument('--telegram-rate', type=int, default=1000, help='messages per second of the stand-in')
+    arg_parser.add_argument('--owm-latency', type=float, default=0.05, help='mean response time, seconds')
+    arg_parser.add_argument('--timeout', type=float, default=300, help='maximum delivery time, seconds')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    os.environ[MESSAGES_PER_SECOND_ENV] = str(args.telegram_rate)
+    os.environ[OWM_LATENCY_ENV] = str(args.owm_latency)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ['ICON_PACK_PATH'] = os.path.join(tmp_dir, 'icons.npy')
+        make_icon_pack(os.environ['ICON_PACK_PATH'])
+        for n_shards in args.shards:
+            result = asyncio.run(run(n_shards, args, os.path.join(tmp_dir, f'shards{n_shards}.sqlite3')))
+            print(f"{n_shards} shards: {result['sent']} reports in {result['elapsed']:.1f} s, "
+                  f"{result['sent'] / result['elapsed']:.0f} messages/s, per shard {result['per_shard']}")
+
+
+if __name__ == '__main__':
+    main()
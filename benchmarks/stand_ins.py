@@ -0,0 +1,155 @@
+"""
+In-process stand-ins of openweathermap.org and the Telegram Bot API for the offline benchmarks.
+"""
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict, deque
+import httpx
+from telegram.request import BaseRequest
+from benchmarks.fixtures import FIXTURE_NAMES, load_fixture
+
+
+class FakeOpenWeatherMap:
+    """
+    Stand-in of the /data/2.5/forecast endpoint serving the recorded responses shifted to the current time.
+    The coordinates of the requested location are put into the response, so each location has its own forecast.
+    """
+    def __init__(self, latency=0.05, error_rate=0.0, seed=0):
+        """
+        :param latency: (float) mean response time, seconds
+        :param error_rate: (float) share of the requests answered with 500 from 0 to 1
+        :param seed: int, seed of the random latencies and errors
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._fixtures = [self.shift_to_now(load_fixture(name)) for name in FIXTURE_NAMES]
+
+    @staticmethod
+    def shift_to_now(weather_data):
+        """Return the response with the first time step moved to the current 3-hour step"""
+        step = 3 * 60 * 60
+        shift = int(time.time()) // step * step - weather_data['list'][0]['dt']
+        city = dict(weather_data['city'], sunrise=weather_data['city']['sunrise'] + shift,
+                    sunset=weather_data['city']['sunset'] + shift)
+        return dict(weather_data, city=city, list=[dict(weather, dt=weather['dt'] + shift)
+                                                   for weather in weather_data['list']])
+
+    def timezone(self, lat, lon):
+        """Return the UTC offset of the forecast served for the location, seconds"""
+        return self._fixture(lat, lon)['city']['timezone']
+
+    def _fixture(self, lat, lon):
+        return self._fixtures[hash((lat, lon)) % len(self._fixtures)]
+
+    @property
+    def transport(self):
+        """Return the transport of httpx.AsyncClient answering the requests in-process"""
+        return httpx.MockTransport(self.handle)
+
+    async def handle(self, request):
+        self.calls += 1
+        await asyncio.sleep(self._random.expovariate(1 / self.latency) if self.latency > 0 else 0)
+        if self._random.random() < self.error_rate:
+            self.errors += 1
+            return httpx.Response(500, json={'cod': '500', 'message': 'Internal error'})
+        lat = float(request.url.params['lat'])
+        lon = float(request.url.params['lon'])
+        fixture = self._fixture(lat, lon)
+        city = dict(fixture['city'], coord={'lat': lat, 'lon': lon})
+        return httpx.Response(200, content=json.dumps(dict(fixture, city=city)).encode('utf-8'))
+
+
+class FakeTelegramRequest(BaseRequest):
+    """
+    Stand-in of the Telegram Bot API for telegram.Bot(request=...). It accepts sendPhoto and sendMessage,
+    enforces the global and per-chat limits of Telegram with 429 responses and records the delivery times.
+    getUpdates serves the updates added by push_update.
+    """
+    def __init__(self, messages_per_second=30, chat_messages_per_second=1, latency=0.02):
+        """
+        :param messages_per_second: int, global limit of messages within a second
+        :param chat_messages_per_second: int, limit of messages to one chat within a second
+        :param latency: (float) response time, seconds
+        """
+        self.messages_per_second = messages_per_second
+        self.chat_messages_per_second = chat_messages_per_second
+        self.latency = latency
+        self.enforce_limits = True
+        self.delivered = defaultdict(list)  # {method: [(chat_id, time.time()), ...]}
+        self.rejected = 0
+        self._sent_times = deque()
+        self._chat_sent_times = defaultdict(deque)
+        self._message_id = 0
+        self._updates = deque()
+        self._update_id = 0
+
+    def push_update(self, update):
+        """
+        Add an update to be received by getUpdates, its update_id is set
+        :param update: (dict) update without the update_id, e.g. {'message': {...}}
+        """
+        self._update_id += 1
+        self._updates.append(dict(update, update_id=self._update_id))
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        await asyncio.sleep(self.latency)
+        endpoint = url.rsplit('/', 1)[-1]
+        if endpoint == 'getMe':
+            return 200, self._ok({'id': 1, 'is_bot': True, 'first_name': 'Umbrella', 'username': 'umbrella_bot'})
+        parameters = request_data.parameters if request_data is not None else {}
+        if endpoint == 'deleteWebhook':
+            return 200, self._ok(True)
+        if endpoint == 'getUpdates':
+            return 200, self._ok(await self._get_updates(parameters))
+        chat_id = int(parameters['chat_id'])
+        now = time.monotonic()
+        if self.enforce_limits and self._is_throttled(chat_id, now):
+            self.rejected += 1
+            return 429, json.dumps({'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                    'parameters': {'retry_after': 1}}).encode('utf-8')
+        self._sent_times.append(now)
+        self._chat_sent_times[chat_id].append(now)
+        self.delivered[endpoint].append((chat_id, time.time()))
+        self._message_id += 1
+        message = {'message_id': self._message_id, 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        if endpoint == 'sendPhoto':
+            file_id = parameters['photo'] if isinstance(parameters.get('photo'), str) else f'photo{self._message_id}'
+            message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 455, 'height': 310}]
+        else:
+            message['text'] = parameters.get('text', '')
+        return 200, self._ok(message)
+
+    async def _get_updates(self, parameters):
+        """Return the pending updates, long polling for at most a second"""
+        deadline = time.monotonic() + min(float(parameters.get('timeout') or 0), 1)
+        while not self._updates and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        offset = int(parameters.get('offset') or 0)
+        while self._updates and self._updates[0]['update_id'] < offset:
+            self._updates.popleft()
+        return [update for update in self._updates if update['update_id'] >= offset]
+
+    def _is_throttled(self, chat_id, now):
+        since = now - 1
+        for sent_times in (self._sent_times, self._chat_sent_times[chat_id]):
+            while sent_times and sent_times[0] < since:
+                sent_times.popleft()
+        return (len(self._sent_times) >= self.messages_per_second
+                or len(self._chat_sent_times[chat_id]) >= self.chat_messages_per_second)
+
+    @staticmethod
+    def _ok(result):
+        return json.dumps({'ok': True, 'result': result}).encode('utf-8')
@@ -0,0 +1,92 @@
+"""
+Measure the cold start of the bot: the time from the start of the process to the reply to /start sent during
+the restart, the import time and the resident memory at that moment. Each run is a fresh interpreter in an empty
+directory, offline against the in-process stand-ins of openweathermap.org and the Telegram Bot API.
+
+Usage: python -m benchmarks.startup [--runs N]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules expected to be loaded only by the render workers or on first use
+HEAVY_MODULES = ('matplotlib', 'scipy', 'PIL', 'requests')
+
+
+def rss_mb():
+    """Return the resident memory of the process, MiB"""
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('VmRSS:')) / 1024
+
+
+async def child(started_at):
+    """Start the bot like main.py does and wait for the reply to /start, return the measurements"""
+    from ui_handler import UIBuilder
+    imported_at = time.time()
+    from benchmarks.stand_ins import FakeOpenWeatherMap, FakeTelegramRequest
+
+    telegram = FakeTelegramRequest()
+    telegram.push_update({'message': {
+        'message_id': 1, 'date': int(time.time()), 'chat': {'id': 42, 'type': 'private'},
+        'from': {'id': 42, 'is_bot': False, 'first_name': 'User'}, 'text': '/start',
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}})
+    ui = UIBuilder('123456:startup', 'startup', bot_request=telegram, owm_transport=FakeOpenWeatherMap().transport)
+    application = ui.application
+    # The steps of Application.run_polling
+    async with application:
+        await application.post_init(application)
+        await application.updater.start_polling()
+        await application.start()
+        polling_at = time.time()
+        while not telegram.delivered['sendMessage']:
+            await asyncio.sleep(0.001)
+        _, replied_at = telegram.delivered['sendMessage'][0]
+        result = {'import': imported_at - started_at, 'polling': polling_at - started_at,
+                  'first_response': replied_at - started_at, 'rss_mb': rss_mb(),
+                  'heavy_modules': [name for name in HEAVY_MODULES if name in sys.modules]}
+        await application.updater.stop()
+        await application.stop()
+        await application.post_stop(application)
+    await application.post_shutdown(application)
+    return result
+
+
+def run_once():
+    """Run the bot in a fresh interpreter and return its measurements"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = dict(os.environ, PYTHONPATH=REPO_ROOT, METRICS_PORT='')
+        started_at = time.time()
+        process = subprocess.run([sys.executable, '-m', 'benchmarks.startup', '--child', str(started_at)],
+                                 cwd=tmp_dir, env=env, capture_output=True, text=True, timeout=120)
+    if process.returncode != 0:
+        raise RuntimeError(f"The bot failed to start:\n{process.stderr}")
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--runs', type=int, default=5, help='number of cold starts')
+    arg_parser.add_argument('--child', type=float, help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+    if args.child is not None:
+        print(json.dumps(asyncio.run(child(args.child))))
+        return
+
+    results = [run_once() for _ in range(args.runs)]
+    for name, title in (('import', 'Import of ui_handler'), ('polling', 'Polling started'),
+                        ('first_response', 'First response')):
+        values = [result[name] * 1000 for result in results]
+        print(f"{title}: median {statistics.median(values):.0f} ms, min {min(values):.0f} ms")
+    print(f"RSS at the first response: median {statistics.median(r['rss_mb'] for r in results):.0f} MiB")
+    print(f"Heavy modules loaded at the first response: {', '.join(results[-1]['heavy_modules']) or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+from threading import Lock
+from time import monotonic
+from urllib.parse import urlsplit
+from logger import logger
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of the requests to a host.
+    After failure_threshold consecutive failures the circuit opens and the requests fail fast for reset_timeout
+    seconds. Then a single trial request is let through: its success closes the circuit, its failure opens it again.
+    """
+    def __init__(self, name, failure_threshold=5, reset_timeout=60):
+        """
+        :param name: str, name of the protected host used in the logs
+        :param failure_threshold: int, number of consecutive failures opening the circuit
+        :param reset_timeout: float, seconds to wait before the trial request
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        """
+        Check if a request may be made
+        :return: (bool)
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_in_flight or monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Circuit to %s is closed", self.name)
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """Let another request be the trial if the trial request was interrupted, e.g. cancelled"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or (self._opened_at is None and self._failures >= self.failure_threshold):
+                logger.error("Circuit to %s is open after %d failures", self.name, self._failures)
+                self._opened_at = monotonic()
+            self._trial_in_flight = False
+
+
+_breakers = {}
+_breakers_lock = Lock()
+
+
+def get_circuit_breaker(url):
+    """
+    Return the circuit breaker of the host of the url
+    :param url: str
+    :return: (CircuitBreaker)
+    """
+    host = urlsplit(url).netloc
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
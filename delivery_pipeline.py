@@ -0,0 +1,93 @@
+import asyncio
+import metrics
+from delivery_queue import DeliveryQueue
+from delivery_scheduler import DeliveryScheduler
+from prefetcher import Prefetcher
+from render_pool import RenderPool
+from subscriptions import SubscriptionRegistry
+from weather_mailer import WeatherMailer
+from logger import logger
+
+TELEGRAM_MESSAGES_PER_SECOND = 30  # limit of the messages sent by a bot
+PREFETCH_SHARE = 0.5  # share of the API plan of the parser used by the prefetcher, the rest is for the live requests
+
+
+class DeliveryPipeline:
+    """
+    Delivery side of the bot: the scheduler, the prefetcher, the render pool and the delivery queue of the mailer.
+    It runs in the bot process, or in each delivery shard process with a share of the subscriptions and rate limits.
+    """
+    # Concurrent senders of the delivery queue, the connection pool of the bot is sized for them
+    delivery_workers = 16
+
+    def __init__(self, bot, owmparser, store, share=1.0, owns=None, render_workers=None, spread_window=60,
+                 messages_per_second=TELEGRAM_MESSAGES_PER_SECOND):
+        """
+        :param bot: (telegram.Bot) bot sending the messages
+        :param owmparser: (AsyncOpenweathermapParser) client of the OpenWeatherMap service
+        :param store: (SQLitePersistence) store of the subscriptions
+        :param share: (float) share of the rate limit of Telegram given to this pipeline, the prefetcher gets
+         PREFETCH_SHARE of the plan of the owmparser
+        :param owns: callable taking a Subscription and telling if the pipeline delivers to its chat
+         (default=None, all the chats)
+        :param render_workers: int, number of render processes (default=number of cores)
+        :param spread_window: (float) maximum spread of the messages of a hot minute, seconds
+        :param messages_per_second: (float) limit of the messages sent by the bot, this pipeline gets its share
+        """
+        self.owmparser = owmparser
+        self.store = store
+        self.owns = owns
+        self.scheduler = DeliveryScheduler()
+        self.delivery_queue = DeliveryQueue(messages_per_second=messages_per_second * share,
+                                            spread_window=spread_window, workers=self.delivery_workers)
+        self.render_pool = RenderPool(render_workers)
+        self.registry = SubscriptionRegistry(store=store)
+        self.mailer = WeatherMailer(owmparser, bot, self.scheduler, self.delivery_queue, self.render_pool,
+                                    self.registry)
+        self.prefetcher = Prefetcher(self.mailer, self.scheduler,
+                                     calls_per_minute=owmparser.calls_per_minute * PREFETCH_SHARE)
+        self._warm_up_task = None
+
+    async def start(self, render_warm_up_delay=0):
+        """
+        Restore the subscriptions and start the delivery on the running event loop
+        :param render_warm_up_delay: (float) seconds before the render workers load the plotting stack
+        """
+        subscriptions = self.store.iter_subscriptions()
+        if self.owns is not None:
+            subscriptions = (subscription for subscription in subscriptions if self.owns(subscription))
+        n_loaded = self.registry.load(subscriptions)
+        self.mailer.reschedule_all()
+        logger.info("Restored %d subscriptions", n_loaded)
+        self._warm_up_task = asyncio.create_task(self.render_pool.warm_up(render_warm_up_delay))
+        self.delivery_queue.start()
+        self.scheduler.start()
+        self.prefetcher.start()
+
+    async def stop(self):
+        """Stop the delivery scheduler and the workers and close the connections"""
+        if self._warm_up_task is not None:
+            self._warm_up_task.cancel()
+            await asyncio.gather(self._warm_up_task, return_exceptions=True)
+        await self.prefetcher.stop()
+        await self.scheduler.stop()
+        await self.delivery_queue.stop()
+        self.render_pool.shutdown()
+        await self.owmparser.aclose()
+
+    def stats(self):
+        """Return the counters of the delivery"""
+        return dict(self.delivery_queue.stats(), subscriptions=len(self.registry), jobs=len(self.scheduler))
+
+    def register_metrics(self):
+        """Expose the counters kept by the components of the pipeline"""
+        for result, attr in (('hit', 'hits'), ('miss', 'misses')):
+            metrics.FORECAST_CACHE_REQUESTS.labels(result).set_function(
+                lambda attr=attr: getattr(self.owmparser.forecast_cache, attr))
+            metrics.RENDER_CACHE_REQUESTS.labels(result).set_function(
+                lambda attr=attr: getattr(self.mailer.render_cache, attr))
+        for result in ('sent', 'failed', 'retried', 'throttled'):
+            metrics.DELIVERIES.labels(result).set_function(lambda attr=result: getattr(self.delivery_queue, attr))
+        metrics.DELIVERY_QUEUE_LENGTH.set_function(lambda: len(self.delivery_queue))
+        metrics.SCHEDULED_JOBS.set_function(lambda: len(self.scheduler))
+        metrics.ACTIVE_SUBSCRIPTIONS.set_function(lambda: len(self.registry))
@@ -0,0 +1,216 @@
+import asyncio
+import random
+from collections import OrderedDict, deque
+from time import monotonic
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from logger import logger
+from metrics import DELIVERY_LAG, SEND_LATENCY
+from rate_limit import TokenBucket
+
+
+class DeliveryJob:
+    """
+    Message to be sent to a chat
+    """
+    __slots__ = ('chat_id', 'send', 'attempt', 'submitted_at')
+
+    def __init__(self, chat_id, send):
+        """
+        :param chat_id: The ID of the Telegram chat
+        :param send: coroutine function without arguments sending the message, called again on retry
+        """
+        self.chat_id = chat_id
+        self.send = send
+        self.attempt = 0
+        self.submitted_at = monotonic()
+
+
+class DeliveryQueue:
+    """
+    Queue between the scheduler and Telegram pacing the sends with the global and per-chat limits of Telegram.
+    The jobs of a hot minute are spread over a window, a 429 response pauses all the sends for `retry_after`,
+    other transient errors are retried with exponential backoff.
+    """
+    # Share of the limits used for the pacing. Telegram counts the messages over a sliding second,
+    # so sending at the exact limit draws 429 responses, and each of them pauses all the sends
+    headroom = 0.9
+    # Per-chat buckets kept, the least recently used ones are forgotten once they are full again
+    max_chat_buckets = 10000
+
+    def __init__(self, messages_per_second=30, chat_messages_per_second=1, spread_window=60,
+                 max_attempts=5, backoff_base=1.0, workers=16, report_interval=60):
+        """
+        :param messages_per_second: (float) global limit of messages sent by the bot
+        :param chat_messages_per_second: (float) limit of messages sent to one chat
+        :param spread_window: (float) maximum spread of the jobs submitted at the same time beyond the global limit
+        :param max_attempts: (int) maximum number of attempts to send a message
+        :param backoff_base: (float) delay before the first retry, seconds. It doubles with every attempt
+        :param workers: (int) number of concurrent senders
+        :param report_interval: (float) seconds between the log records of the delivery stats
+        """
+        self.chat_messages_per_second = chat_messages_per_second
+        self.spread_window = spread_window
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.n_workers = workers
+        self.report_interval = report_interval
+        self._global_bucket = TokenBucket(messages_per_second * self.headroom, capacity=1)
+        self._chat_buckets = OrderedDict()
+        self._queue = asyncio.Queue()
+        self._delayed = {}  # job: asyncio.TimerHandle putting it into the queue
+        self._burst_started_at = 0
+        self._burst_size = 0
+        self._workers = []
+        self._sent_times = deque()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+
+    def start(self):
+        """Start the sending workers on the running event loop"""
+        if not self._workers:
+            logger.info('Starting %d delivery workers', self.n_workers)
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.n_workers)]
+            self._workers.append(asyncio.create_task(self._reporter()))
+
+    async def stop(self):
+        """Stop the sending workers, jobs left in the queue or waiting to be put into it are dropped"""
+        for handle in self._delayed.values():
+            handle.cancel()
+        if self._delayed or len(self):
+            logger.warning("Dropped %d undelivered messages", len(self._delayed) + len(self))
+        self._delayed.clear()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, chat_id, send):
+        """
+        Add a message to the queue. The messages submitted within a second are queued at once while they fit
+        into the global limit. The rest of a hot burst is put at a random moment of the time needed to send
+        the burst, at most the spread window, so it does not block the messages submitted after it
+        :param chat_id: The ID of the Telegram chat
+        :param send: coroutine function without arguments sending the message
+        """
+        now = monotonic()
+        if now - self._burst_started_at >= 1:
+            self._burst_started_at = now
+            self._burst_size = 0
+        self._burst_size += 1
+        rate = self._global_bucket.rate
+        delay = 0
+        if self._burst_size > rate:
+            delay = random.uniform(0, min(self.spread_window, self._burst_size / rate))
+        self._put_later(DeliveryJob(chat_id, send), delay)
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def throughput(self, window=60):
+        """
+        Return sustained throughput of the delivered messages
+        :param window: (float) averaging window, seconds
+        :return: (float) messages per second
+        """
+        since = monotonic() - window
+        while self._sent_times and self._sent_times[0] < since:
+            self._sent_times.popleft()
+        return len(self._sent_times) / window
+
+    def stats(self):
+        """Return the counters of the delivery"""
+        return {'sent': self.sent, 'failed': self.failed, 'retried': self.retried, 'throttled': self.throttled,
+                'queued': len(self), 'delayed': len(self._delayed), 'throughput': self.throughput()}
+
+    def _put_later(self, job, delay):
+        if delay > 0:
+            self._delayed[job] = asyncio.get_running_loop().call_later(delay, self._put_delayed, job)
+        else:
+            self._queue.put_nowait(job)
+
+    def _put_delayed(self, job):
+        del self._delayed[job]
+        self._queue.put_nowait(job)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is not None:
+            self._chat_buckets.move_to_end(chat_id)
+            return bucket
+        bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_messages_per_second * self.headroom,
+                                                           capacity=1)
+        # The oldest chats are not limited anymore when their buckets are full, so they are forgotten
+        while len(self._chat_buckets) > self.max_chat_buckets:
+            oldest = next(iter(self._chat_buckets.values()))
+            if not oldest.is_full:
+                break
+            self._chat_buckets.popitem(last=False)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._chat_bucket(job.chat_id).acquire()
+                await self._global_bucket.acquire()
+                await self._send(job)
+            finally:
+                self._queue.task_done()
+
+    async def _reporter(self):
+        reported_sent = 0
+        while True:
+            await asyncio.sleep(self.report_interval)
+            if self.sent != reported_sent or len(self):
+                reported_sent = self.sent
+                logger.info("Delivery stats: %s", self.stats())
+
+    async def _send(self, job):
+        job.attempt += 1
+        started_at = monotonic()
+        try:
+            await job.send()
+        except Exception as e:
+            retry_after = self._get_retry_after(e)
+            SEND_LATENCY.labels('throttled' if retry_after is not None else 'error').observe(monotonic() - started_at)
+            if retry_after is not None:
+                # The flood wait applies to the whole bot, the job is queued again behind the pause
+                self.throttled += 1
+                self._global_bucket.pause(retry_after)
+                delay = 0
+            elif self._is_transient(e):
+                delay = self.backoff_base * 2 ** (job.attempt - 1) * random.uniform(0.5, 1.5)
+            else:
+                self.failed += 1
+                logger.error("Failed to deliver to chat %d: %r", job.chat_id, e)
+                return
+            if job.attempt >= self.max_attempts:
+                self.failed += 1
+                logger.error("Gave up delivering to chat %d after %d attempts: %r", job.chat_id, job.attempt, e)
+                return
+            self.retried += 1
+            logger.warning("Attempt %d: Failed to deliver to chat %d, retry in %.1f s: %r",
+                           job.attempt, job.chat_id, retry_after if retry_after is not None else delay, e)
+            self._put_later(job, delay)
+            return
+        now = monotonic()
+        SEND_LATENCY.labels('ok').observe(now - started_at)
+        DELIVERY_LAG.observe(now - job.submitted_at)
+        self.sent += 1
+        self._sent_times.append(now)
+
+    @staticmethod
+    def _get_retry_after(e):
+        """Return seconds to wait requested by a 429 response of Telegram or None"""
+        if isinstance(e, RetryAfter):
+            return e.retry_after
+        return None
+
+    @staticmethod
+    def _is_transient(e):
+        """Check if the error is worth retrying"""
+        if isinstance(e, BadRequest):
+            return False
+        return isinstance(e, (NetworkError, asyncio.TimeoutError))
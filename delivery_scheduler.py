@@ -0,0 +1,114 @@
+import asyncio
+import time
+from subscriptions import MINUTES_PER_DAY
+from logger import logger
+from metrics import SCHEDULER_LAG
+
+
+class DeliveryScheduler:
+    """
+    Single scheduler of the daily jobs of all subscribers running on the asyncio event loop.
+    Jobs are kept in a table of buckets by the UTC minute of the day, the loop wakes up at the start of each minute
+    and dispatches only the jobs of its bucket.
+    """
+    def __init__(self):
+        self._buckets = [{} for _ in range(MINUTES_PER_DAY)]  # {key: job_func} of each UTC minute of the day
+        self._jobs = {}  # {key: minute_of_day}
+        self._task = None
+        self._running_jobs = set()
+        self._last_tick = None  # minutes since the epoch dispatched last
+
+    def every_day_at(self, key, minute_of_day, job_func):
+        """
+        Schedule a job to run every day at the given UTC minute. An existing job with the same key is replaced.
+        :param key: hashable, id of the job, e.g. (chat_id, 'report')
+        :param minute_of_day: int, UTC minute of the day e.g. 480 for "08:00" UTC
+        :param job_func: coroutine function or callable without arguments. Callables run in a worker thread
+        """
+        self.cancel(key)
+        self._jobs[key] = minute_of_day
+        self._buckets[minute_of_day][key] = job_func
+
+    def cancel(self, key):
+        """
+        Cancel the job
+        :param key: hashable, id of the job
+        """
+        minute_of_day = self._jobs.pop(key, None)
+        if minute_of_day is not None:
+            del self._buckets[minute_of_day][key]
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, key):
+        return key in self._jobs
+
+    def upcoming(self, seconds):
+        """
+        Return the jobs due within the next seconds, only the buckets of these minutes are read
+        :param seconds: (float)
+        :return: (list) keys of the jobs
+        """
+        now = time.time() / 60
+        first = int(now) + 1  # the jobs of the current minute are already dispatched
+        last = min(int(now + seconds / 60), first + MINUTES_PER_DAY - 1)
+        keys = []
+        for minute in range(first, last + 1):
+            keys.extend(self._buckets[minute % MINUTES_PER_DAY])
+        return keys
+
+    async def join(self):
+        """Wait for the dispatched jobs to finish"""
+        while self._running_jobs:
+            await asyncio.gather(*self._running_jobs, return_exceptions=True)
+
+    def start(self):
+        """Start the scheduler loop on the running event loop"""
+        if self._task is None:
+            logger.info('Starting delivery scheduler')
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the scheduler loop"""
+        if self._task is not None:
+            logger.info('Stopping delivery scheduler')
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        """Sleep until the start of the next minute and dispatch the due jobs"""
+        self._last_tick = int(time.time() // 60)
+        while True:
+            await asyncio.sleep(60 - time.time() % 60)
+            self.run_pending()
+
+    def run_pending(self):
+        """Dispatch the jobs of all the minutes since the last tick, e.g. after the event loop was blocked"""
+        now = int(time.time() // 60)
+        if self._last_tick is None:
+            self._last_tick = now - 1
+        # After a gap longer than a day each job is dispatched once
+        for minute in range(max(self._last_tick + 1, now - MINUTES_PER_DAY + 1), now + 1):
+            SCHEDULER_LAG.observe(time.time() - minute * 60)
+            for key, job_func in list(self._buckets[minute % MINUTES_PER_DAY].items()):
+                self._dispatch(key, job_func)
+        self._last_tick = max(self._last_tick, now)
+
+    def _dispatch(self, key, job_func):
+        if asyncio.iscoroutinefunction(job_func):
+            coro = job_func()
+        else:
+            coro = asyncio.to_thread(job_func)
+        task = asyncio.create_task(coro, name=f"delivery-{key}")
+        self._running_jobs.add(task)
+        task.add_done_callback(self._on_job_done)
+
+    def _on_job_done(self, task):
+        self._running_jobs.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Job %s failed: %r", task.get_name(), task.exception())
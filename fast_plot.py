@@ -0,0 +1,227 @@
+import io
+import math
+from functools import lru_cache
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from icon_atlas import icon_atlas
+
+# Layout of the 5x3 inch matplotlib figure at 100 dpi cropped with bbox_inches='tight'
+WIDTH, HEIGHT = 455, 310
+PLOT_LEFT, PLOT_RIGHT, PLOT_TOP, PLOT_BOTTOM = 56, WIDTH - 7, 30, HEIGHT - 44
+N_SMOOTH_POINTS = 100
+ICON_SIZE = 35
+TICK_SIZE = 5
+LEGEND_WIDTH, LEGEND_HEIGHT = 116, 48
+LINE_COLORS = ((31, 119, 180), (255, 127, 14))  # matplotlib C0 and C1
+LINE_LABELS = ('Real', 'Feels like')
+TEXT_COLOR = (0, 0, 0)
+FONT_SIZE = 14  # 10 pt
+TITLE_FONT_SIZE = 17  # 12 pt
+
+
+def natural_cubic_spline(x, y, n_points=N_SMOOTH_POINTS):
+    """
+    Evaluate natural cubic splines of several curves sharing the knots
+    :param x: (np.array) knots with shape (n,)
+    :param y: (np.array) values with shape (n, k) for k curves
+    :param n_points: int, number of evenly spaced points to evaluate
+    :return: x_range with shape (n_points,), y_interp with shape (n_points, k)
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float).reshape(len(x), -1)
+    h = np.diff(x)
+
+    # Solve the tridiagonal system for the second derivatives, they are zero at the ends
+    m = np.zeros_like(y)
+    if len(x) > 2:
+        a = np.diag(2 * (h[:-1] + h[1:])) + np.diag(h[1:-1], 1) + np.diag(h[1:-1], -1)
+        slopes = np.diff(y, axis=0) / h[:, None]
+        m[1:-1] = np.linalg.solve(a, 6 * np.diff(slopes, axis=0))
+
+    x_range = np.linspace(x[0], x[-1], n_points)
+    i = np.clip(np.searchsorted(x, x_range, side='right') - 1, 0, len(x) - 2)
+    hi = h[i][:, None]
+    left = (x[i + 1] - x_range)[:, None]
+    right = (x_range - x[i])[:, None]
+    y_interp = (m[i] * left ** 3 + m[i + 1] * right ** 3) / (6 * hi) \
+        + (y[i] / hi - m[i] * hi / 6) * left + (y[i + 1] / hi - m[i + 1] * hi / 6) * right
+
+    # Set the first and last points of the interpolated curve to the original data points
+    y_interp[0] = y[0]
+    y_interp[-1] = y[-1]
+    return x_range, y_interp
+
+
+def nice_ticks(y_min, y_max, max_ticks=6):
+    """
+    Return evenly spaced round tick values within the range
+    :return: (np.array)
+    """
+    span = max(y_max - y_min, 1e-9)
+    raw_step = span / max_ticks
+    magnitude = 10 ** math.floor(math.log10(raw_step))
+    step = next(k * magnitude for k in (1, 2, 2.5, 5, 10) if k * magnitude >= raw_step)
+    return np.arange(math.ceil(y_min / step) * step, y_max + step * 1e-9, step)
+
+
+@lru_cache(maxsize=None)
+def get_font(size):
+    """Return the font of the given size, falling back to the PIL default font"""
+    for name in ('DejaVuSans.ttf', 'Arial.ttf'):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            pass
+    return ImageFont.load_default()
+
+
+@lru_cache(maxsize=1024)
+def get_text_mask(text, size=FONT_SIZE, rotate=False):
+    """
+    Return the rendered text as a grayscale mask, the labels repeat from plot to plot so they are rendered once
+    :param text: str
+    :param size: int, font size
+    :param rotate: bool, rotate the text by 90 degrees counterclockwise
+    :return: (PIL.Image) mask of mode 'L'
+    """
+    font = get_font(size)
+    x0, y0, x1, y1 = font.getbbox(text)
+    mask = Image.new('L', (max(x1 - x0, 1), max(y1 - y0, 1)), 0)
+    ImageDraw.Draw(mask).text((-x0, -y0), text, fill=255, font=font)
+    return mask.transpose(Image.ROTATE_90) if rotate else mask
+
+
+@lru_cache(maxsize=64)
+def get_icon(icon_id):
+    """Return the icon scaled to the size on the plot"""
+    return Image.fromarray(np.asarray(icon_atlas.get(icon_id))).resize((ICON_SIZE, ICON_SIZE), Image.LANCZOS)
+
+
+class FastPlotRenderer:
+    """
+    Renderer of the forecast chart drawing directly into a PIL RGB buffer.
+    The frame, the axis labels and the legend are drawn once and copied for every chart.
+    """
+    def __init__(self):
+        self._background = self._make_background()
+        self._legend = self._make_legend()
+
+    @staticmethod
+    def _paste_text(img, text, xy, anchor='la', size=FONT_SIZE, rotate=False):
+        """
+        Paste the text at the point
+        :param anchor: str, horizontal ('l', 'm', 'r') and vertical ('a', 'm', 'b') alignment to the point
+        """
+        mask = get_text_mask(text, size, rotate)
+        w, h = mask.size
+        x = xy[0] - {'l': 0, 'm': w // 2, 'r': w}[anchor[0]]
+        y = xy[1] - {'a': 0, 'm': h // 2, 'b': h}[anchor[1]]
+        img.paste(TEXT_COLOR, (x, y, x + w, y + h), mask)
+
+    def _make_background(self):
+        img = Image.new('RGB', (WIDTH, HEIGHT), (255, 255, 255))
+        self._paste_text(img, 'Time, h', ((PLOT_LEFT + PLOT_RIGHT) // 2, HEIGHT - 3), anchor='mb')
+        self._paste_text(img, 'Temperature, °C', (3, (PLOT_TOP + PLOT_BOTTOM) // 2), anchor='lm', rotate=True)
+        return img
+
+    def _make_legend(self):
+        img = Image.new('RGBA', (LEGEND_WIDTH, LEGEND_HEIGHT), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        draw.rounded_rectangle((0, 0, LEGEND_WIDTH - 1, LEGEND_HEIGHT - 1), radius=3,
+                               fill=(255, 255, 255, 128), outline=(204, 204, 204, 128))
+        for i, (color, label) in enumerate(zip(LINE_COLORS, LINE_LABELS)):
+            y = 13 + i * 21
+            draw.line((7, y, 35, y), fill=color, width=2)
+            self._paste_text(img, label, (45, y), anchor='lm')
+        return img
+
+    def render(self, forecast):
+        """
+        Render the chart of the forecast
+        :param forecast: (Forecast) parsed forecast
+        :return: (PIL.Image) RGB image
+        """
+        time_ts = np.asarray(forecast.time_ts, dtype=float)
+        temp_ts = np.asarray(forecast.temp_ts, dtype=float)
+        curves = np.column_stack((temp_ts, forecast.temp_feels_like_ts))
+        time_smooth, curves_smooth = natural_cubic_spline(time_ts, curves)
+
+        # Data to pixel transforms with the 5% margins of matplotlib
+        x_margin = 0.05 * (time_ts[-1] - time_ts[0])
+        x_min, x_max = time_ts[0] - x_margin, time_ts[-1] + x_margin
+        y_lo, y_hi = curves_smooth.min(), curves_smooth.max()
+        y_margin = 0.05 * max(y_hi - y_lo, 1)
+        y_min, y_max = y_lo - y_margin, y_hi + y_margin
+        x_scale = (PLOT_RIGHT - PLOT_LEFT) / (x_max - x_min)
+        y_scale = (PLOT_BOTTOM - PLOT_TOP) / (y_max - y_min)
+
+        def to_px(x, y):
+            return PLOT_LEFT + (x - x_min) * x_scale, PLOT_BOTTOM - (y - y_min) * y_scale
+
+        img = self._background.copy()
+        draw = ImageDraw.Draw(img, 'RGBA')
+
+        # Fill the area between sunset and sunrise with a dark color
+        night_mask = (time_ts >= forecast.time_sunset) | (time_ts <= forecast.time_sunrise)
+        _, band_top = to_px(0, temp_ts.max())
+        _, band_bottom = to_px(0, temp_ts.min())
+        night_steps = np.concatenate(([False], night_mask[:-1] & night_mask[1:], [False])).astype(np.int8)
+        run_edges = np.flatnonzero(np.diff(night_steps))  # the steps between neighbour night points as runs
+        for start, end in zip(run_edges[::2], run_edges[1::2]):
+            band_left, _ = to_px(time_ts[start], 0)
+            band_right, _ = to_px(time_ts[end], 0)
+            draw.rectangle((band_left, band_top, band_right, band_bottom), fill=(0, 0, 0, 77))
+
+        # Ticks
+        for timestamp in time_ts:
+            x, _ = to_px(timestamp, 0)
+            draw.line((x, PLOT_BOTTOM, x, PLOT_BOTTOM + TICK_SIZE), fill=TEXT_COLOR)
+            label = forecast.local_time(timestamp).strftime('%H:00')
+            self._paste_text(img, label, (int(x), PLOT_BOTTOM + TICK_SIZE + 4), anchor='ma')
+        for tick in nice_ticks(y_min, y_max):
+            _, y = to_px(0, tick)
+            draw.line((PLOT_LEFT - TICK_SIZE, y, PLOT_LEFT, y), fill=TEXT_COLOR)
+            self._paste_text(img, f'{tick:g}', (PLOT_LEFT - TICK_SIZE - 4, int(y)), anchor='rm')
+
+        # Curves
+        xs = PLOT_LEFT + (time_smooth - x_min) * x_scale
+        ys = PLOT_BOTTOM - (curves_smooth - y_min) * y_scale
+        for k, color in enumerate(LINE_COLORS):
+            draw.line(list(zip(xs.tolist(), ys[:, k].tolist())), fill=color, width=2, joint='curve')
+
+        # Icons in the vertical center of the plot
+        y_center = (PLOT_TOP + PLOT_BOTTOM) // 2
+        for timestamp, icon_id in zip(time_ts, forecast.icon_ts):
+            x, _ = to_px(timestamp, 0)
+            icon = get_icon(icon_id)
+            img.paste(icon, (int(x) - ICON_SIZE // 2, y_center - ICON_SIZE // 2), icon)
+
+        img.paste(self._legend, (PLOT_RIGHT - LEGEND_WIDTH - 6, PLOT_TOP + 6), self._legend)
+        draw.rectangle((PLOT_LEFT, PLOT_TOP, PLOT_RIGHT, PLOT_BOTTOM), outline=TEXT_COLOR)
+
+        title_date = forecast.local_time(forecast.time_sunrise).strftime("%d %B %Y")
+        title = f"{forecast.city}, {forecast.country}, {title_date}"
+        self._paste_text(img, title, ((PLOT_LEFT + PLOT_RIGHT) // 2, PLOT_TOP - 6), anchor='mb',
+                         size=TITLE_FONT_SIZE)
+        return img
+
+    def render_png(self, forecast):
+        """
+        Render the chart of the forecast
+        :param forecast: (Forecast) parsed forecast
+        :return: (bytes) PNG image
+        """
+        buffer = io.BytesIO()
+        self.render(forecast).save(buffer, format='png', compress_level=1)
+        return buffer.getvalue()
+
+
+_renderer = None
+
+
+def get_renderer():
+    """Return the shared renderer, its layout is built on the first call"""
+    global _renderer
+    if _renderer is None:
+        _renderer = FastPlotRenderer()
+    return _renderer
@@ -0,0 +1,213 @@
+import struct
+from datetime import datetime, timedelta, timezone
+import numpy as np
+
+FORECAST_STEPS = 40  # 3-hour steps of the 5 day forecast of openweathermap.org
+STEP_DTYPE = np.dtype([
+    ('time', '<i8'),  # unix time of the step
+    ('temp', '<f4'),  # °C
+    ('feels_like', '<f4'),  # °C
+    ('pop', '<f4'),  # probability of precipitation from 0 to 1
+    ('rain', '<f4'),  # rain volume in mm per step
+    ('weather_id', '<i2'),  # weather condition id
+    ('icon', 'u1'),  # icon code, see encode_icon
+])
+# Header of the serialized forecast: lat, lon, sunrise, sunset, timezone, number of steps, city and country lengths
+HEADER = struct.Struct('<ddqqiHBB')
+
+# Weather conditions of openweathermap.org: id -> (main, description)
+CONDITIONS = {
+    200: ('Thunderstorm', 'thunderstorm with light rain'),
+    201: ('Thunderstorm', 'thunderstorm with rain'),
+    202: ('Thunderstorm', 'thunderstorm with heavy rain'),
+    210: ('Thunderstorm', 'light thunderstorm'),
+    211: ('Thunderstorm', 'thunderstorm'),
+    212: ('Thunderstorm', 'heavy thunderstorm'),
+    221: ('Thunderstorm', 'ragged thunderstorm'),
+    230: ('Thunderstorm', 'thunderstorm with light drizzle'),
+    231: ('Thunderstorm', 'thunderstorm with drizzle'),
+    232: ('Thunderstorm', 'thunderstorm with heavy drizzle'),
+    300: ('Drizzle', 'light intensity drizzle'),
+    301: ('Drizzle', 'drizzle'),
+    302: ('Drizzle', 'heavy intensity drizzle'),
+    310: ('Drizzle', 'light intensity drizzle rain'),
+    311: ('Drizzle', 'drizzle rain'),
+    312: ('Drizzle', 'heavy intensity drizzle rain'),
+    313: ('Drizzle', 'shower rain and drizzle'),
+    314: ('Drizzle', 'heavy shower rain and drizzle'),
+    321: ('Drizzle', 'shower drizzle'),
+    500: ('Rain', 'light rain'),
+    501: ('Rain', 'moderate rain'),
+    502: ('Rain', 'heavy intensity rain'),
+    503: ('Rain', 'very heavy rain'),
+    504: ('Rain', 'extreme rain'),
+    511: ('Rain', 'freezing rain'),
+    520: ('Rain', 'light intensity shower rain'),
+    521: ('Rain', 'shower rain'),
+    522: ('Rain', 'heavy intensity shower rain'),
+    531: ('Rain', 'ragged shower rain'),
+    600: ('Snow', 'light snow'),
+    601: ('Snow', 'snow'),
+    602: ('Snow', 'heavy snow'),
+    611: ('Snow', 'sleet'),
+    612: ('Snow', 'light shower sleet'),
+    613: ('Snow', 'shower sleet'),
+    615: ('Snow', 'light rain and snow'),
+    616: ('Snow', 'rain and snow'),
+    620: ('Snow', 'light shower snow'),
+    621: ('Snow', 'shower snow'),
+    622: ('Snow', 'heavy shower snow'),
+    701: ('Mist', 'mist'),
+    711: ('Smoke', 'smoke'),
+    721: ('Haze', 'haze'),
+    731: ('Dust', 'sand/dust whirls'),
+    741: ('Fog', 'fog'),
+    751: ('Sand', 'sand'),
+    761: ('Dust', 'dust'),
+    762: ('Ash', 'volcanic ash'),
+    771: ('Squall', 'squalls'),
+    781: ('Tornado', 'tornado'),
+    800: ('Clear', 'clear sky'),
+    801: ('Clouds', 'few clouds'),
+    802: ('Clouds', 'scattered clouds'),
+    803: ('Clouds', 'broken clouds'),
+    804: ('Clouds', 'overcast clouds'),
+}
+
+
+def encode_icon(icon_id):
+    """
+    Encode the icon id of openweathermap.org as a small integer
+    :param icon_id: str, e.g. '02n'
+    :return: (int) e.g. 5
+    """
+    return int(icon_id[:2]) * 2 + (icon_id[2] == 'n')
+
+
+def decode_icon(code):
+    """
+    Decode the icon id encoded by encode_icon
+    :param code: (int) e.g. 5
+    :return: str, e.g. '02n'
+    """
+    return f"{code // 2:02d}{'dn'[code % 2]}"
+
+
+class Forecast:
+    """
+    Parsed forecast of a location. The time steps are stored as columns of a structured array
+    with fixed dtypes, so the forecast is small in the caches and it is serialized to bytes cheaply.
+    """
+    __slots__ = ('lat', 'lon', 'city', 'country', 'time_sunrise', 'time_sunset', 'timezone', 'steps')
+
+    def __init__(self, lat, lon, city, country, time_sunrise, time_sunset, timezone, steps):
+        """
+        :param lat: (float) latitude
+        :param lon: (float) longitude
+        :param city: str, city name
+        :param country: str, country code
+        :param time_sunrise: (int) unix time of the sunrise
+        :param time_sunset: (int) unix time of the sunset
+        :param timezone: (int) shift of the location time zone from UTC in seconds
+        :param steps: (np.ndarray) structured array of STEP_DTYPE
+        """
+        self.lat = lat
+        self.lon = lon
+        self.city = city
+        self.country = country
+        self.time_sunrise = time_sunrise
+        self.time_sunset = time_sunset
+        self.timezone = timezone
+        self.steps = steps
+
+    def __repr__(self):
+        return f"Forecast({self.city}, {self.country}, {len(self.steps)} steps)"
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __reduce__(self):
+        return Forecast.from_bytes, (self.to_bytes(),)
+
+    @property
+    def time_ts(self):
+        return self.steps['time']
+
+    @property
+    def temp_ts(self):
+        return self.steps['temp']
+
+    @property
+    def temp_feels_like_ts(self):
+        return self.steps['feels_like']
+
+    @property
+    def pop_ts(self):
+        return self.steps['pop']
+
+    @property
+    def rain_ts(self):
+        return self.steps['rain']
+
+    @property
+    def weather_id_ts(self):
+        return self.steps['weather_id']
+
+    @property
+    def icon_ts(self):
+        """Return the icon ids of the steps, e.g. ['02n', '03n']"""
+        return [decode_icon(code) for code in self.steps['icon'].tolist()]
+
+    @property
+    def main(self):
+        """Return the weather condition groups of the steps, e.g. ['Clouds', 'Rain']"""
+        return [CONDITIONS.get(weather_id, ('', ''))[0] for weather_id in self.steps['weather_id'].tolist()]
+
+    @property
+    def description(self):
+        """Return the weather conditions of the steps, e.g. ['few clouds', 'light rain']"""
+        return [CONDITIONS.get(weather_id, ('', ''))[1] for weather_id in self.steps['weather_id'].tolist()]
+
+    def local_time(self, timestamp):
+        """
+        Return the datetime of the unix time in the time zone of the location
+        :param timestamp: (float) unix time
+        :return: (datetime)
+        """
+        return datetime.fromtimestamp(timestamp, timezone(timedelta(seconds=self.timezone)))
+
+    def head(self, n_steps):
+        """
+        Return the forecast of the first time steps, the steps are shared with this forecast
+        :param n_steps: int, number of time steps
+        :return: (Forecast)
+        """
+        return Forecast(self.lat, self.lon, self.city, self.country, self.time_sunrise, self.time_sunset,
+                        self.timezone, self.steps[:n_steps])
+
+    def to_bytes(self):
+        """
+        Serialize the forecast
+        :return: (bytes)
+        """
+        city = self.city.encode('utf-8')[:255]
+        country = self.country.encode('utf-8')[:255]
+        header = HEADER.pack(self.lat, self.lon, self.time_sunrise, self.time_sunset, self.timezone,
+                             len(self.steps), len(city), len(country))
+        return b''.join((header, city, country, self.steps.tobytes()))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Deserialize the forecast serialized by to_bytes, the steps are a read-only view of the data
+        :param data: (bytes)
+        :return: (Forecast)
+        """
+        lat, lon, time_sunrise, time_sunset, timezone, n_steps, city_len, country_len = HEADER.unpack_from(data)
+        offset = HEADER.size
+        city = data[offset:offset + city_len].decode('utf-8', 'ignore')
+        offset += city_len
+        country = data[offset:offset + country_len].decode('utf-8', 'ignore')
+        offset += country_len
+        steps = np.frombuffer(data, dtype=STEP_DTYPE, count=n_steps, offset=offset)
+        return cls(lat, lon, city, country, time_sunrise, time_sunset, timezone, steps)
@@ -0,0 +1,205 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future
+from threading import Lock
+from time import monotonic
+from logger import logger
+
+GRID_STEP = 0.05  # degrees
+FORECAST_TTL = 3 * 60 * 60  # seconds, time step of the openweathermap.org forecast
+
+
+def quantize_latlon(lat, lon, grid_step=GRID_STEP):
+    """
+    Return the grid cell containing the location
+    :param lat: (float) latitude
+    :param lon: (float) longitude
+    :param grid_step: (float) size of the cell in degrees
+    :return: (tuple) (lat_index, lon_index)
+    """
+    return round(lat / grid_step), round(lon / grid_step)
+
+
+class ForecastCache:
+    """
+    LRU cache of the parsed forecasts keyed on the location grid cell.
+    Concurrent misses for the same cell wait for a single in-flight request.
+    get_or_fetch serves threads, get_or_fetch_async serves the event loop. Their in-flight requests are different
+    futures and the event loop path does not take the lock, so one cache is used by one of them:
+    each parser has its own cache.
+    """
+    def __init__(self, grid_step=GRID_STEP, ttl=FORECAST_TTL, max_size=10000):
+        """
+        :param grid_step: (float) size of the cell in degrees
+        :param ttl: (float) time to live of an entry, seconds
+        :param max_size: (int) maximum number of cached cells
+        """
+        self.grid_step = grid_step
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def cell(self, lat, lon):
+        """Return the cache key of the location"""
+        return quantize_latlon(lat, lon, self.grid_step)
+
+    def get(self, lat, lon):
+        """
+        Return the cached forecast of the location or None if it is missing or expired
+        :param lat: (float) latitude
+        :param lon: (float) longitude
+        """
+        key = self.cell(lat, lon)
+        with self._lock:
+            return self._get_fresh(key)
+
+    def expires_in(self, lat, lon):
+        """
+        Return seconds until the cached forecast of the location expires, 0 if it is missing or expired
+        :param lat: (float) latitude
+        :param lon: (float) longitude
+        """
+        with self._lock:
+            entry = self._entries.get(self.cell(lat, lon))
+        return max(entry[0] - monotonic(), 0) if entry is not None else 0
+
+    def get_stale(self, lat, lon):
+        """
+        Return the cached forecast of the location even if it is expired, or None if it was evicted
+        :param lat: (float) latitude
+        :param lon: (float) longitude
+        """
+        entry = self._entries.get(self.cell(lat, lon))
+        return entry[1] if entry is not None else None
+
+    def put(self, lat, lon, value):
+        """Store the forecast of the location"""
+        key = self.cell(lat, lon)
+        with self._lock:
+            self._put(key, value)
+
+    def get_or_fetch(self, lat, lon, fetch):
+        """
+        Return the cached forecast of the location or fetch it
+        :param lat: (float) latitude
+        :param lon: (float) longitude
+        :param fetch: callable without arguments returning the forecast or None on failure. None is not cached
+        :return: the forecast or None
+        """
+        key = self.cell(lat, lon)
+        while True:
+            with self._lock:
+                value = self._get_fresh(key)
+                if value is not None:
+                    self.hits += 1
+                    return value
+                future = self._in_flight.get(key)
+                if future is None:
+                    self.misses += 1
+                    future = Future()
+                    self._in_flight[key] = future
+                    break
+                self.hits += 1
+            try:
+                return future.result()
+            except CancelledError:
+                pass  # the owner of the request was interrupted, the request is made again
+
+        try:
+            value = fetch()
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        except BaseException:
+            with self._lock:
+                del self._in_flight[key]
+            future.cancel()
+            raise
+        with self._lock:
+            if value is not None:
+                self._put(key, value)
+            del self._in_flight[key]
+        future.set_result(value)
+        return value
+
+    async def get_or_fetch_async(self, lat, lon, fetch, force=False):
+        """
+        Return the cached forecast of the location or fetch it on the event loop
+        :param lat: (float) latitude
+        :param lon: (float) longitude
+        :param fetch: coroutine function without arguments returning the forecast or None on failure
+        :param force: bool, fetch even if the cached forecast is fresh, e.g. to refresh it before it expires.
+         A request in flight for the cell is still awaited instead of making another one
+        :return: the forecast or None
+        """
+        key = self.cell(lat, lon)
+        value = self._get_fresh(key) if not force else None
+        if value is not None:
+            self.hits += 1
+            return value
+        while True:
+            future = self._in_flight.get(key)
+            if future is None:
+                break
+            self.hits += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # this caller is cancelled
+                # The owner of the request was cancelled, not this caller, so the request is made again
+                value = self._get_fresh(key) if not force else None
+                if value is not None:
+                    return value
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            value = await fetch()
+        except Exception as e:
+            del self._in_flight[key]
+            future.set_exception(e)
+            future.exception()  # mark as retrieved if nobody is waiting
+            raise
+        except BaseException:
+            # The cancellation of the owner is not passed to the waiters, they make the request again
+            del self._in_flight[key]
+            future.cancel()
+            raise
+        if value is not None:
+            self._put(key, value)
+        del self._in_flight[key]
+        future.set_result(value)
+        return value
+
+    def stats(self):
+        """Return the hit/miss counters"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def _get_fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < monotonic():
+            # The expired entry is kept as the last good forecast until it is evicted
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _put(self, key, value):
+        self._entries[key] = (monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            evicted_key, _ = self._entries.popitem(last=False)
+            logger.debug("Evicted forecast of cell %s", evicted_key)
@@ -0,0 +1,183 @@
+import difflib
+import math
+import mmap
+import os
+import re
+import unicodedata
+from collections import OrderedDict
+from forecast_cache import quantize_latlon
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gazetteer.tsv")
+REVERSE_GRID_STEP = 0.1  # degrees, cell of the offline reverse lookup
+FUZZY_WINDOW = 32  # lines around the insertion point compared by the fuzzy lookup
+
+
+def normalize_name(name):
+    """
+    Normalize the city name for the lookup: case-folded, without accents, punctuation and repeated spaces
+    :param name: str, e.g. " São  Paulo"
+    :return: str, e.g. "sao paulo"
+    """
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return re.sub(r'\s+', ' ', re.sub(r'[^\w\s]', ' ', name.casefold())).strip()
+
+
+class Gazetteer:
+    """
+    Offline geocoder of the city names and the locations.
+    The bundled gazetteer file is sorted by the normalized name and looked up by binary search over the
+    memory-mapped file. The results of the API lookups are remembered in LRU caches.
+    File format: tab-separated lines of normalized name, city, country, lat, lon, population.
+    Lines with the same name are sorted by decreasing population, so the largest city is found first.
+    """
+    def __init__(self, path=GAZETTEER_PATH, max_size=100000):
+        """
+        :param path: str, path to the gazetteer file, None to use only the remembered lookups
+        :param max_size: int, maximum number of the remembered lookups of each kind
+        """
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._names = OrderedDict()
+        self._cells = OrderedDict()
+        self._mm = None
+        self._reverse_index = None
+        if path is not None and os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def lookup_city(self, name):
+        """
+        Resolve the city name
+        :param name: str, city name typed by the user
+        :return: (dict) {'cod': '200', 'lat': lat, 'lon': lon, 'city': city, 'country': country} or None
+        """
+        key = normalize_name(name)
+        metadata = self._names.get(key)
+        if metadata is None and self._mm is not None:
+            metadata = self._search_file(key)
+        if metadata is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(self._names, key, metadata)
+        return metadata
+
+    def lookup_location(self, lat, lon):
+        """
+        Resolve the location to the city
+        :param lat: (float) latitude
+        :param lon: (float) longitude
+        :return: (dict) {'cod': '200', 'lat': lat, 'lon': lon, 'city': city, 'country': country} or None
+        """
+        metadata = self._cells.get(quantize_latlon(lat, lon))
+        if metadata is None and self._mm is not None:
+            metadata = self._search_reverse_index(lat, lon)
+        if metadata is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return metadata
+
+    def remember_city(self, name, metadata):
+        """
+        Remember the result of the API lookup of the city name, the location of the city is remembered too
+        :param name: str, city name typed by the user
+        :param metadata: (dict) result of OpenweathermapParser.parse_response_metadata
+        """
+        self._remember(self._names, normalize_name(name), metadata)
+        self.remember_location(metadata['lat'], metadata['lon'], metadata)
+
+    def remember_location(self, lat, lon, metadata):
+        """
+        Remember the result of the API lookup of the location
+        :param lat: (float) latitude
+        :param lon: (float) longitude
+        :param metadata: (dict) result of OpenweathermapParser.parse_response_metadata
+        """
+        self._remember(self._cells, quantize_latlon(lat, lon), metadata)
+
+    def stats(self):
+        """Return the hit/miss counters"""
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _remember(self, cache, key, metadata):
+        cache[key] = metadata
+        cache.move_to_end(key)
+        if len(cache) > self.max_size:
+            cache.popitem(last=False)
+
+    @staticmethod
+    def _parse_line(line):
+        _, city, country, lat, lon, _ = line.decode('utf-8').split('\t')
+        return {'cod': '200', 'lat': float(lat), 'lon': float(lon), 'city': city, 'country': country}
+
+    def _line_bounds(self, pos):
+        """Return the start and the end of the line containing the byte position"""
+        start = self._mm.rfind(b'\n', 0, pos) + 1
+        end = self._mm.find(b'\n', pos)
+        return start, end if end != -1 else len(self._mm)
+
+    def _bisect(self, key):
+        """Return the byte position of the first line with the name not less than the key"""
+        lo, hi = 0, len(self._mm)
+        while lo < hi:
+            start, end = self._line_bounds((lo + hi) // 2)
+            if self._mm[start:self._mm.find(b'\t', start, end)] < key:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+    def _search_file(self, key):
+        encoded_key = key.encode('utf-8')
+        pos = self._bisect(encoded_key)
+        if pos < len(self._mm):
+            start, end = self._line_bounds(pos)
+            line = self._mm[start:end]
+            if line.split(b'\t', 1)[0] == encoded_key:
+                return self._parse_line(line)
+        return self._search_fuzzy(pos, key)
+
+    def _search_fuzzy(self, pos, key):
+        """Return the closest name among the lines around the insertion point of the key"""
+        lines = {}
+        start = pos
+        for _ in range(FUZZY_WINDOW // 2):
+            if start == 0:
+                break
+            start = self._line_bounds(start - 1)[0]
+        for _ in range(FUZZY_WINDOW):
+            if start >= len(self._mm):
+                break
+            _, end = self._line_bounds(start)
+            line = self._mm[start:end]
+            lines.setdefault(line.split(b'\t', 1)[0].decode('utf-8'), line)
+            start = end + 1
+        matches = difflib.get_close_matches(key, lines, n=1, cutoff=0.85)
+        return self._parse_line(lines[matches[0]]) if matches else None
+
+    def _build_reverse_index(self):
+        index = {}
+        for line in self._mm[:].splitlines():
+            metadata = self._parse_line(line)
+            index.setdefault(quantize_latlon(metadata['lat'], metadata['lon'], REVERSE_GRID_STEP), metadata)
+        return index
+
+    def _search_reverse_index(self, lat, lon):
+        """Return the nearest city of the gazetteer within a cell of the reverse grid"""
+        if self._reverse_index is None:
+            self._reverse_index = self._build_reverse_index()
+        cell_lat, cell_lon = quantize_latlon(lat, lon, REVERSE_GRID_STEP)
+        best, best_distance = None, REVERSE_GRID_STEP
+        for d_lat in (-1, 0, 1):
+            for d_lon in (-1, 0, 1):
+                metadata = self._reverse_index.get((cell_lat + d_lat, cell_lon + d_lon))
+                if metadata is None:
+                    continue
+                distance = math.hypot(metadata['lat'] - lat, (metadata['lon'] - lon) * math.cos(math.radians(lat)))
+                if distance <= best_distance:
+                    best, best_distance = metadata, distance
+        return best
@@ -0,0 +1,88 @@
+import io
+import os
+import tempfile
+import urllib.request
+from threading import Lock
+import numpy as np
+from logger import logger
+
+ICON_PACK_PATH = os.environ.get("ICON_PACK_PATH", "icons.npy")
+ICON_SIZE = 100  # pixels, size of the @2x icons of openweathermap.org
+ICON_IDS = [f"{code}{day_time}" for code in ("01", "02", "03", "04", "09", "10", "11", "13", "50")
+            for day_time in ("d", "n")]
+ICON_INDEX = {icon_id: i for i, icon_id in enumerate(ICON_IDS)}
+
+
+class IconAtlas:
+    """
+    In-memory store of the decoded RGBA weather icons backed by a memory-mapped pack on disk.
+    The pack is downloaded from openweathermap.org once and reused by all the later runs.
+    """
+    def __init__(self, pack_path=ICON_PACK_PATH):
+        """
+        :param pack_path: str, path to the .npy pack of icons with shape (len(ICON_IDS), ICON_SIZE, ICON_SIZE, 4)
+        """
+        self.pack_path = pack_path
+        self._pack = None
+        self._extra_icons = {}
+        self._lock = Lock()
+
+    def build_pack(self):
+        """Download the icons into the pack on disk if it does not exist, the pack is not mapped"""
+        if os.path.exists(self.pack_path):
+            return
+        logger.info(f"Downloading the weather icons to {self.pack_path}")
+        pack = np.stack([self.download_icon(icon_id) for icon_id in ICON_IDS])
+        # Other processes may build the pack at the same time, each one writes its own file and replaces the pack
+        fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(os.path.abspath(self.pack_path)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, pack)
+            os.replace(tmp_path, self.pack_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def load(self):
+        """Map the pack of icons into memory, download it first if it does not exist"""
+        with self._lock:
+            if self._pack is not None:
+                return
+            self.build_pack()
+            self._pack = np.load(self.pack_path, mmap_mode='r')
+
+    def get(self, icon_id):
+        """
+        Return the image of the icon
+        :param icon_id: str, e.g. '02n'
+        :return: (np.array), RGBA image of the icon with shape (ICON_SIZE, ICON_SIZE, 4)
+        """
+        index = ICON_INDEX.get(icon_id)
+        if index is None:
+            # Unknown icon, fetch it once and keep it out of the pack
+            with self._lock:
+                if icon_id not in self._extra_icons:
+                    self._extra_icons[icon_id] = self.download_icon(icon_id)
+                return self._extra_icons[icon_id]
+        if self._pack is None:
+            self.load()
+        return self._pack[index]
+
+    @staticmethod
+    def download_icon(icon_id):
+        """
+        Return image from openweathermap.org for correspondent icon_id
+        :param icon_id: str, e.g. '02n'
+        :return: (np.array), RGBA image of the icon with shape (ICON_SIZE, ICON_SIZE, 4)
+        """
+        from PIL import Image  # only needed to build the pack
+        img_url = f'https://openweathermap.org/img/wn/{icon_id}@2x.png'
+        with urllib.request.urlopen(img_url) as url:
+            img_data = url.read()
+        img = Image.open(io.BytesIO(img_data)).convert('RGBA')
+        if img.size != (ICON_SIZE, ICON_SIZE):
+            img = img.resize((ICON_SIZE, ICON_SIZE))
+        return np.array(img)
+
+
+icon_atlas = IconAtlas()
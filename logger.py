@@ -1,30 +1,238 @@
+import atexit
+import json
 import logging
+import multiprocessing
+import os
+import queue
 import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, RotatingFileHandler
 
 LOGGER_NAME = "Logger"
 LOGGER_FILE_NAME = "logs.log"
+# Settings of the logger read from the environment
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG')
+LOG_JSON = os.getenv('LOG_JSON', '0') == '1'  # write JSON lines instead of the text lines
+LOG_CALLER = os.getenv('LOG_CALLER', '1') == '1'  # write the file, function and line of the call
+LOG_QUEUED = os.getenv('LOG_QUEUED', '1') == '1'  # write the records in a background thread
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))  # size of the file to rotate at
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))  # number of the rotated files kept
+LOG_QUEUE_SIZE = 10000  # records waiting for the writer, the new records are dropped when it is full
 
+_listener = None  # writer thread of the queued mode
 
-def create_logger():
-    """Creates a logger with settings"""
+TEXT_FORMAT = '%(asctime)s-%(levelname)s-FILE:%(filename)s-FUNC:%(funcName)s-LINE:%(lineno)d-%(message)s'
+TEXT_FORMAT_NO_CALLER = '%(asctime)s-%(levelname)s-%(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """Format the record as a line of JSON"""
+    def __init__(self, caller=True):
+        """
+        :param caller: bool, add the file, function and line of the call
+        """
+        super().__init__()
+        self.caller = caller
+
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                 'level': record.levelname, 'message': record.getMessage()}
+        if self.caller:
+            entry.update(file=record.filename, func=record.funcName, line=record.lineno)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """Rotating file handler writing a batch of records with one write and one flush"""
+    def emit_batch(self, records):
+        """
+        Format and write the records, the file is rotated before the batch if it would exceed maxBytes
+        :param records: list of logging.LogRecord
+        """
+        self.acquire()
+        try:
+            text = ''.join(self.format(record) + self.terminator for record in records)
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes > 0 and 0 < self.stream.tell() and self.stream.tell() + len(text) >= self.maxBytes:
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            self.stream.write(text)
+            self.stream.flush()
+        except Exception:
+            self.handleError(records[-1])
+        finally:
+            self.release()
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Queue handler which only puts the record into the queue. The message is formatted by the writer thread,
+    so the arguments of the record should not be changed after the call. When the queue is full the record is dropped.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchingQueueListener:
+    """
+    Writer thread taking the records from the queue and passing everything queued so far to the handlers at once
+    """
+    _STOP = None
+
+    def __init__(self, log_queue, handlers, queue_handler=None, batch_size=500):
+        """
+        :param log_queue: (queue.Queue) queue of the records
+        :param handlers: list of logging.Handler, BatchRotatingFileHandler gets the records in batches
+        :param queue_handler: (NonBlockingQueueHandler) handler feeding the queue, its dropped records are reported
+        :param batch_size: int, maximum number of records written at once
+        """
+        self.queue = log_queue
+        self.handlers = handlers
+        self.queue_handler = queue_handler
+        self.batch_size = batch_size
+        self._reported_dropped = 0
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Write the records queued so far and stop the thread"""
+        if self._thread is not None:
+            self.queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            batch = []
+            record = self.queue.get()
+            while record is not self._STOP:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._report_dropped(batch)
+            if batch:
+                self._write(batch)
+            if record is self._STOP:
+                return
+
+    def _report_dropped(self, batch):
+        dropped = self.queue_handler.dropped if self.queue_handler is not None else 0
+        if dropped > self._reported_dropped:
+            batch.append(logging.makeLogRecord({
+                'name': LOGGER_NAME, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': f"Dropped {dropped - self._reported_dropped} log records, the log queue was full"}))
+            self._reported_dropped = dropped
+
+    def _write(self, batch):
+        for handler in self.handlers:
+            records = [record for record in batch if record.levelno >= handler.level]
+            if not records:
+                continue
+            if isinstance(handler, BatchRotatingFileHandler):
+                handler.emit_batch(records)
+            else:
+                for record in records:
+                    handler.handle(record)
+
+
+def create_logger(level=LOG_LEVEL, json_lines=LOG_JSON, caller=LOG_CALLER, queued=LOG_QUEUED, file_name=None):
+    """
+    Creates a logger with settings. In the queued mode a call only puts the record into a queue
+    and a background thread formats the records and writes them to the rotated file in batches.
+    Pass the arguments of the messages logged on the hot paths to the logger, e.g. logger.debug("Cell %s", key),
+    so they are formatted only if the level is enabled and off the calling thread.
+    :param level: str, minimum level of the records, e.g. 'INFO'
+    :param json_lines: bool, write JSON lines instead of the text lines
+    :param caller: bool, write the file, function and line of the call
+    :param queued: bool, write in a background thread
+    :param file_name: str, rotated file of the records of this process (default=None, LOGGER_FILE_NAME
+     in the main process. The worker processes append to it synchronously without rotation,
+     only the main process rotates it)
+    """
+    global _listener
     logger = logging.getLogger(LOGGER_NAME)
-    logger.setLevel(logging.DEBUG)
+    if logger.handlers:
+        return logger
+    logger.setLevel(level)
 
     # Create Formatter
-    formatter = logging.Formatter(
-        '%(asctime)s-%(levelname)s-FILE:%(filename)s-FUNC:%(funcName)s-LINE:%(lineno)d-%(message)s')
+    if json_lines:
+        formatter = JsonFormatter(caller)
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT if caller else TEXT_FORMAT_NO_CALLER)
 
-    # create a file handler and add it to logger
-    file_handler = logging.FileHandler(LOGGER_FILE_NAME)
+    # create a file handler, the worker processes without their own file append to the file of the main process
+    if file_name is None and multiprocessing.parent_process() is not None:
+        queued = False
+        file_handler = logging.FileHandler(LOGGER_FILE_NAME, delay=True)
+    else:
+        file_handler = BatchRotatingFileHandler(file_name or LOGGER_FILE_NAME, maxBytes=LOG_MAX_BYTES,
+                                                backupCount=LOG_BACKUP_COUNT, delay=True)
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
 
     stream_handler = logging.StreamHandler(sys.stdout)
     stream_handler.setLevel(logging.ERROR)
     stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
+
+    if not queued:
+        logger.addHandler(file_handler)
+        logger.addHandler(stream_handler)
+        return logger
+
+    # the handlers are called by the listener thread, the logger only enqueues the records
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    listener = BatchingQueueListener(queue_handler.queue, [file_handler, stream_handler], queue_handler)
+    listener.start()
+    _listener = listener
+    atexit.register(stop_logging)
+    logger.addHandler(queue_handler)
     return logger
 
 
+def log_to_own_file(file_name):
+    """
+    Write the records of this worker process to its own rotated file like the main process does,
+    instead of appending to the file of the main process synchronously. Call stop_logging before the process
+    exits, the worker processes do not run the atexit handlers
+    :param file_name: str, e.g. 'logs.shard-0.log'
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+    return create_logger(file_name=file_name)
+
+
+def stop_logging():
+    """Write the records queued so far and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
 logger = create_logger()
@@ -1,12 +1,20 @@
-from ui_handler import UIBuilder
+import argparse
 import os
 from dotenv import load_dotenv
-load_dotenv()
+load_dotenv()  # before the imports, the logger reads its settings from the environment
+from ui_handler import UIBuilder  # noqa: E402
 
 
 def main():
     """Run the bot."""
-    ui = UIBuilder(os.getenv('TELEGRAMBOT_TOKEN'), os.getenv('OPENWEATHERMAP_TOKEN'))
+    arg_parser = argparse.ArgumentParser(description="Telegram weather bot")
+    arg_parser.add_argument('--shards', type=int, default=int(os.getenv('DELIVERY_SHARDS', 0)),
+                            help='number of the delivery worker processes, 0 to deliver in the bot process')
+    args = arg_parser.parse_args()
+    metrics_port = os.getenv('METRICS_PORT')
+    ui = UIBuilder(os.getenv('TELEGRAMBOT_TOKEN'), os.getenv('OPENWEATHERMAP_TOKEN'),
+                   metrics_port=int(metrics_port) if metrics_port else None, shards=args.shards,
+                   owm_calls_per_minute=float(os.getenv('OPENWEATHERMAP_CALLS_PER_MINUTE', 60)))
     ui.application.run_polling()
 
 
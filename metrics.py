@@ -0,0 +1,394 @@
+import asyncio
+import os
+import sys
+import threading
+from bisect import bisect_left
+from collections import Counter as StackCounter
+from time import perf_counter
+from urllib.parse import parse_qs, urlsplit
+from logger import logger
+
+# Upper bounds of the histogram buckets, seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class Registry:
+    """
+    Metrics exposed by the bot, rendered in the Prometheus text format
+    """
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def render(self):
+        """
+        Render all the metrics
+        :return: str, text exposition format of Prometheus
+        """
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.collect())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value not in (float('inf'), float('-inf')) else ('+Inf' if value > 0 else '-Inf')
+
+
+class _Metric:
+    """
+    Base of the metrics, a metric with labels keeps a child of each combination of the label values
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        """
+        :param name: str, name of the metric, e.g. 'umbrella_upstream_requests_total'
+        :param documentation: str, one line description
+        :param labelnames: (tuple) names of the labels, e.g. ('status',)
+        :param registry: (Registry) registry exposing the metric (default=REGISTRY)
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._children[()] = self._make_child()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """
+        Return the child of the label values
+        :param values: values of the labels in the order of labelnames, converted to str
+        """
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self._make_child())
+        return child
+
+    def collect(self):
+        """Yield the samples of the metric as lines of the text format"""
+        for values, child in list(self._children.items()):
+            yield from child.collect(self.name, dict(zip(self.labelnames, values)))
+
+    def _make_child(self):
+        raise NotImplementedError
+
+
+class _Value:
+    """Value of a counter or a gauge, it is read from the function if one is set"""
+    __slots__ = ('_value', '_function', '_lock')
+
+    def __init__(self):
+        self._value = 0.0
+        self._function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        """
+        Read the value from the function when the metrics are collected, e.g. from the counters of a cache
+        :param function: callable without arguments returning a number
+        """
+        self._function = function
+
+    def get(self):
+        return self._function() if self._function is not None else self._value
+
+    def collect(self, name, labels):
+        yield f"{name}{_format_labels(labels)} {_format_value(self.get())}"
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, e.g. of requests"""
+    kind = 'counter'
+
+    def _make_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+
+class Gauge(Counter):
+    """Value going up and down, e.g. the queue length"""
+    kind = 'gauge'
+
+    def set(self, value):
+        self._default.set(value)
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', '_counts', '_sum', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def time(self):
+        """Return a context manager observing the time spent in its block, seconds"""
+        return _Timer(self)
+
+    def collect(self, name, labels):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield f"{name}_bucket{_format_labels(dict(labels, le=_format_value(upper_bound)))} {cumulative}"
+        yield f"{name}_sum{_format_labels(labels)} {_format_value(total)}"
+        yield f"{name}_count{_format_labels(labels)} {cumulative}"
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(perf_counter() - self._start)
+
+
+class Histogram(_Metric):
+    """Distribution of the observed values in cumulative buckets, e.g. of the latencies"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        """
+        :param buckets: (tuple) sorted upper bounds of the buckets, +Inf is added
+        """
+        self.buckets = tuple(float(bound) for bound in buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _make_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+
+class SamplingProfiler:
+    """
+    Sampling profiler of all the threads of the process, it can be switched on and off at runtime.
+    The stacks are collected in the collapsed format of the flame graph tools.
+    """
+    def __init__(self, interval=0.01, max_depth=64):
+        """
+        :param interval: (float) seconds between the samples
+        :param max_depth: (int) maximum number of frames of a stack
+        """
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks = StackCounter()
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @property
+    def is_running(self):
+        return self._thread is not None
+
+    def start(self, interval=None):
+        """
+        Start sampling in a daemon thread, the collected stacks are kept
+        :param interval: (float) seconds between the samples (default=the interval of the profiler)
+        """
+        if interval is not None:
+            self.interval = interval
+        if self._thread is None:
+            logger.info(f'Starting sampling profiler every {self.interval} s')
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop sampling"""
+        if self._thread is not None:
+            logger.info(f'Stopping sampling profiler after {self.samples} samples')
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def reset(self):
+        """Drop the collected stacks"""
+        self._stacks = StackCounter()
+        self.samples = 0
+
+    def collapsed(self):
+        """
+        Return the collected stacks, the most frequent first
+        :return: str, lines of "outer;...;inner count"
+        """
+        return ''.join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                self._stacks[self._format_stack(frame, names)] += 1
+            self.samples += 1
+
+    def _format_stack(self, frame, names):
+        frames = []
+        while frame is not None and len(frames) < self.max_depth:
+            code = frame.f_code
+            name = names.get(code)
+            if name is None:
+                name = names[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            frames.append(name)
+            frame = frame.f_back
+        return ';'.join(reversed(frames))
+
+
+class MetricsServer:
+    """
+    Local HTTP endpoint of the metrics and the profiler on the asyncio event loop:
+    GET /metrics - metrics in the Prometheus text format
+    GET /profile - stacks collected by the profiler in the collapsed format
+    POST /profile/start?interval=0.01, POST /profile/stop, POST /profile/reset - switch the profiler
+    """
+    def __init__(self, host='127.0.0.1', port=9108, registry=REGISTRY, profiler=None):
+        """
+        :param host: str, interface to listen on, the endpoint has no authentication
+        :param port: int, TCP port
+        :param registry: (Registry) exposed metrics (default=REGISTRY)
+        :param profiler: (SamplingProfiler) profiler switched by the endpoint (default=new SamplingProfiler)
+        """
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.profiler = profiler if profiler is not None else SamplingProfiler()
+        self._server = None
+
+    async def start(self):
+        """Start listening on the running event loop. The bot keeps running without the endpoint if the port is busy"""
+        if self._server is None:
+            try:
+                self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            except OSError as e:
+                logger.error(f'Failed to serve metrics on {self.host}:{self.port}, the endpoint is off: {e!r}')
+                return
+            logger.info(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        """Stop listening and stop the profiler"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        self.profiler.stop()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            while (await asyncio.wait_for(reader.readline(), timeout=10)) not in (b'\r\n', b'\n', b''):
+                pass  # the headers and the body are not used
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            status, body = await self._route(method, urlsplit(target))
+        except (ValueError, asyncio.TimeoutError, ConnectionError):
+            status, body = '400 Bad Request', 'Bad request\n'
+        content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        data = body.encode('utf-8')
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(data)}\r\n"
+                     f"Connection: close\r\n\r\n".encode('latin-1') + data)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def _route(self, method, url):
+        if method == 'GET' and url.path == '/metrics':
+            return '200 OK', self.registry.render()
+        if method == 'GET' and url.path == '/profile':
+            return '200 OK', self.profiler.collapsed()
+        if method == 'POST' and url.path == '/profile/start':
+            interval = parse_qs(url.query).get('interval')
+            self.profiler.start(float(interval[0]) if interval else None)
+            return '200 OK', 'Profiler started\n'
+        if method == 'POST' and url.path == '/profile/stop':
+            # Joining the sampling thread takes up to one interval
+            await asyncio.to_thread(self.profiler.stop)
+            return '200 OK', f'Profiler stopped after {self.profiler.samples} samples\n'
+        if method == 'POST' and url.path == '/profile/reset':
+            self.profiler.reset()
+            return '200 OK', 'Profiler reset\n'
+        return '404 Not Found', 'Not found\n'
+
+
+# Metrics of the delivery pipeline, the counters kept by the components are read through set_function
+UPSTREAM_REQUESTS = Counter('umbrella_upstream_requests_total',
+                            'Requests to api.openweathermap.org by the status code of the response', ('status',))
+UPSTREAM_LATENCY = Histogram('umbrella_upstream_request_seconds', 'Response time of api.openweathermap.org')
+FORECAST_CACHE_REQUESTS = Counter('umbrella_forecast_cache_requests_total',
+                                  'Lookups of the forecast cache by result', ('result',))
+RENDER_CACHE_REQUESTS = Counter('umbrella_render_cache_requests_total',
+                                'Lookups of the rendered plot cache by result', ('result',))
+RENDER_LATENCY = Histogram('umbrella_render_seconds', 'Time to render a plot in the render pool including the wait '
+                           'for a worker', ('backend',))
+SEND_LATENCY = Histogram('umbrella_send_seconds', 'Response time of Telegram to a sent message by outcome',
+                         ('outcome',))
+DELIVERIES = Counter('umbrella_deliveries_total', 'Messages by result of the delivery, '
+                     'throttled are the 429 responses of Telegram', ('result',))
+DELIVERY_LAG = Histogram('umbrella_delivery_lag_seconds', 'Time from the submit of a message to its delivery '
+                         'including the spread window and the retries', buckets=LAG_BUCKETS)
+DELIVERY_QUEUE_LENGTH = Gauge('umbrella_delivery_queue_length', 'Messages waiting for a delivery worker')
+SCHEDULER_LAG = Histogram('umbrella_scheduler_lag_seconds', 'Delay of the dispatch of the jobs of a minute '
+                          'after the start of the minute', buckets=LAG_BUCKETS)
+SCHEDULED_JOBS = Gauge('umbrella_scheduled_jobs', 'Daily jobs in the delivery scheduler')
+ACTIVE_SUBSCRIPTIONS = Gauge('umbrella_active_subscriptions', 'Subscribed chats')
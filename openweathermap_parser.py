@@ -1,14 +1,39 @@
-import requests
+import asyncio
+import json
+import random
+import time
+import httpx
+import numpy as np
+from circuit_breaker import get_circuit_breaker
+from forecast import FORECAST_STEPS, STEP_DTYPE, Forecast, encode_icon
+from forecast_cache import ForecastCache
 from logger import logger
+from metrics import UPSTREAM_LATENCY, UPSTREAM_REQUESTS
+from rate_limit import TokenBucket
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:  # optional, the standard library decoder is a few times slower
+    json_loads = json.loads
 
 
 class OpenweathermapParser:
-    def __init__(self, api_key):
+    def __init__(self, api_key, timeout=10.0, backoff_base=1.0, max_backoff=30.0, forecast_cache=None):
         """
         Class request and parse openweathermap.org data with a 3-day weather forecast with 3h time resolution
         :param api_key: str, api_key for api.openweathermap.org
+        :param timeout: float, timeout of a request in seconds (default=10.0)
+        :param backoff_base: float, maximum delay before the first retry in seconds, doubled with every attempt
+        :param max_backoff: float, maximum delay between the attempts in seconds
+        :param forecast_cache: (ForecastCache) cache of the parsed forecasts, the users of the parser share it,
+         so the API calls scale with distinct locations (default=None, a new cache of this parser)
         """
         self._api_key = api_key
+        self.forecast_cache = forecast_cache if forecast_cache is not None else ForecastCache()
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
 
     def _make_url_get_weather_by_city(self, city):
         """
@@ -27,30 +52,77 @@ class OpenweathermapParser:
         url = f"http://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&appid={self._api_key}&units=metric"
         return url
 
+    def _get(self, url):
+        """Make the GET request and record its status code and response time"""
+        import requests  # imported on the first call, the bot uses the async client
+        with UPSTREAM_LATENCY.time():
+            try:
+                response = requests.get(url, timeout=self.timeout)
+            except requests.RequestException:
+                UPSTREAM_REQUESTS.labels('error').inc()
+                raise
+        UPSTREAM_REQUESTS.labels(response.status_code).inc()
+        return response
+
     def request_openweathermap_by_city(self, city):
         """Make API request to openweathermap.org data for given city"""
         url = self._make_url_get_weather_by_city(city)
-        response = requests.get(url)
+        response = self._get(url)
         return response
 
     def request_openweathermap_by_latlon(self, lat, lon):
         """Make API request to openweathermap.org data for given latitude and longitude"""
         url = self._make_url_get_weather_by_latlon(lat, lon)
-        response = requests.get(url)
+        response = self._get(url)
         return response
 
     @staticmethod
-    def parse_response_metadata(response):
+    def decode_response(response):
+        """
+        Decode the JSON body of the response, with orjson if it is installed
+        :param response: (requests.models.Response or httpx.Response) response from api.openweathermap.org
+        :return: (dict) decoded body
+        :raises ValueError: if the body is not a valid JSON
+        """
+        return json_loads(response.content)
+
+    @classmethod
+    def parse_response(cls, response):
+        """
+        Parse the metadata and the forecast of the response, its body is decoded once
+        :param response: (requests.models.Response or httpx.Response) response from api.openweathermap.org
+        :return: (tuple) (dict, metadata as of parse_response_metadata; Forecast, parsed forecast or None)
+        """
+        try:
+            response_dict = cls.decode_response(response)
+        except ValueError:
+            logger.error("Failed to decode response: %s", response.text)
+            return {'cod': str(response.status_code)}, None
+        metadata_dict = cls._parse_metadata(response_dict, response.status_code)
+        forecast = cls.parse_weather_data(response_dict) if metadata_dict['cod'] == "200" else None
+        return metadata_dict, forecast
+
+    @classmethod
+    def parse_response_metadata(cls, response):
         """
         Parse response from api request to openweathermap.org
         :param response: (requests.models.Response) response from api.openweathermap.org
         :return: (dict), {'cod': cod, 'lat': lat, 'lon': lon, 'city': city, 'country': country} or
          {'cod': cod} meaning the request is not correct
         """
-        response_dict = response.json()
-        cod = response_dict['cod']
-        if cod in ("401", "404"):
-            logger.error(response_dict['message'])
+        try:
+            response_dict = cls.decode_response(response)
+        except ValueError:
+            logger.error("Failed to decode response: %s", response.text)
+            return {'cod': str(response.status_code)}
+        return cls._parse_metadata(response_dict, response.status_code)
+
+    @staticmethod
+    def _parse_metadata(response_dict, status_code):
+        """Extract the metadata from the decoded response, see parse_response_metadata"""
+        cod = str(response_dict.get('cod', status_code))
+        if cod != "200":
+            logger.error(response_dict.get('message'))
             metadata_dict = {'cod': cod}
             return metadata_dict
         lat = response_dict['city']['coord']['lat']
@@ -60,59 +132,213 @@ class OpenweathermapParser:
         metadata_dict = {'cod': cod, 'lat': lat, 'lon': lon, 'city': city, 'country': country}
         return metadata_dict
 
-    def get_weather_dict(self, lat, lon, max_attempts=10):
+    def get_weather_dict(self, lat, lon, max_attempts=10, use_cache=True):
         """
         Extracts relevant weather data from the current weather forecast
         :lat: (float) latitude
         :lon: (float) longitude
         :max_attempts: int, maximum number of attempts to make the request (default=10)
-        :return: dict, dictionary containing weather data for the first 7 time steps (3 hours each) or None.
+        :use_cache: bool, take the forecast from the forecast cache of the parser if it is there and fall back to the last
+         good forecast if the request fails (default=True)
+        :return: (Forecast) parsed forecast or None.
         """
-        # Request OpenWeatherMap API
-        for attempt in range(1, max_attempts):
-            response = self.request_openweathermap_by_latlon(lat, lon)
-            weather_data = response.json()
+        if not use_cache:
+            return self._fetch_weather_dict(lat, lon, max_attempts)
+        forecast = self.forecast_cache.get_or_fetch(
+            lat, lon, lambda: self._fetch_weather_dict(lat, lon, max_attempts))
+        return forecast if forecast is not None else self._get_last_good_forecast(lat, lon)
 
-            # Check response code
-            if weather_data['cod'] == "401":
-                logger.error(weather_data['message'])
-                return None
-            elif weather_data['cod'] == "404":
-                logger.error(f"Failed to request: {lat}, {lon}")
-                return None
-            elif weather_data['cod'] == "200":
-                logger.info(f"Successfully fetched weather forecast on attempt {attempt}")
-                weather_dict = self.parse_weather_data(weather_data)
-                return weather_dict
-            else:
-                logger.warning(f"Attempt {attempt}: Failed to fetch weather forecast. Response text: {response.text}")
+    def _fetch_weather_dict(self, lat, lon, max_attempts):
+        """Request the forecast from openweathermap.org with retries and parse it"""
+        import requests
+        url = self._make_url_get_weather_by_latlon(lat, lon)
+        circuit_breaker = get_circuit_breaker(url)
+        for attempt in range(1, max_attempts + 1):
+            if not circuit_breaker.allow():
+                logger.warning("Circuit to %s is open, skip request: %s, %s", circuit_breaker.name, lat, lon)
                 return None
+            try:
+                response = self._get(url)
+                forecast, retry = self._check_forecast_response(response, lat, lon, attempt)
+            except requests.RequestException as e:
+                logger.warning("Attempt %d: Failed to fetch weather forecast: %r", attempt, e)
+                forecast, retry = None, True
+            except BaseException:
+                # The interrupted request does not keep holding the trial of the half-open circuit
+                circuit_breaker.release_trial()
+                raise
+            if not retry:
+                circuit_breaker.record_success()
+                return forecast
+            circuit_breaker.record_failure()
+            if attempt < max_attempts:
+                time.sleep(self._get_backoff(attempt))
+        return None
+
+    def _check_forecast_response(self, response, lat, lon, attempt):
+        """
+        Check the response and parse the forecast
+        :return: (tuple) (Forecast, parsed forecast or None; bool, if the request is worth retrying)
+        """
+        if response.status_code == 429 or response.status_code >= 500:
+            logger.warning("Attempt %d: Failed to fetch weather forecast. Status code: %d",
+                           attempt, response.status_code)
+            return None, True
+        try:
+            weather_data = self.decode_response(response)
+        except ValueError:
+            logger.warning("Attempt %d: Failed to decode weather forecast. Response text: %s",
+                           attempt, response.text)
+            return None, True
+
+        # Check response code
+        cod = str(weather_data.get('cod'))
+        if cod == "401":
+            logger.error(weather_data['message'])
+            return None, False
+        elif cod == "404":
+            logger.error("Failed to request: %s, %s", lat, lon)
+            return None, False
+        elif cod == "200":
+            try:
+                forecast = self.parse_weather_data(weather_data)
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                logger.warning("Attempt %d: Unexpected weather forecast: %r", attempt, e)
+                return None, True
+            logger.info("Successfully fetched weather forecast on attempt %d", attempt)
+            return forecast, False
+        else:
+            logger.warning("Attempt %d: Failed to fetch weather forecast. Response text: %s",
+                           attempt, response.text)
+            return None, False
+
+    def _get_backoff(self, attempt):
+        """Return delay before the next attempt, exponential with full jitter"""
+        return random.uniform(0, min(self.max_backoff, self.backoff_base * 2 ** (attempt - 1)))
+
+    def _get_last_good_forecast(self, lat, lon):
+        """Return the expired cached forecast of the location or None"""
+        forecast = self.forecast_cache.get_stale(lat, lon)
+        if forecast is not None:
+            logger.warning("Using the last good forecast for %s, %s", lat, lon)
+        return forecast
 
     @staticmethod
     def parse_weather_data(weather_data):
         """
         Parse weather data
         :param weather_data: dictionary of the success response from api.openweather.org
-        :return: dict, dictionary containing weather data for the first 7 time steps (3 hours each)
-        """
-        weather_ts = weather_data['list'][0:7]
-        weather_dict = {
-            'temp_ts': [],
-            'temp_feels_like_ts': [],
-            'time_ts': [],
-            'icon_ts': [],
-            'main': [],
-            'description': [],
-            'time_sunrise': weather_data['city']['sunrise'],
-            'time_sunset': weather_data['city']['sunset'],
-            'city': weather_data['city']['name'],
-            'country': weather_data['city']['country']
-        }
-        for weather in weather_ts:
-            weather_dict['temp_ts'].append(weather['main']['temp'])
-            weather_dict['temp_feels_like_ts'].append(weather['main']['feels_like'])
-            weather_dict['time_ts'].append(weather['dt'])
-            weather_dict['icon_ts'].append(weather['weather'][0]['icon'])
-            weather_dict['main'].append(weather['weather'][0]['main'])
-            weather_dict['description'].append(weather['weather'][0]['description'])
-        return weather_dict
+        :return: (Forecast) forecast of all the time steps (3 hours each)
+        """
+        city = weather_data['city']
+        steps = np.array([(weather['dt'], weather['main']['temp'], weather['main']['feels_like'], weather.get('pop', 0),
+                           weather.get('rain', {}).get('3h', 0), weather['weather'][0]['id'],
+                           encode_icon(weather['weather'][0]['icon']))
+                          for weather in weather_data['list'][:FORECAST_STEPS]], dtype=STEP_DTYPE)
+        return Forecast(city['coord']['lat'], city['coord']['lon'], city['name'], city['country'],
+                        city['sunrise'], city['sunset'], city.get('timezone', 0), steps)
+
+
+class AsyncOpenweathermapParser(OpenweathermapParser):
+    def __init__(self, api_key, max_concurrency=20, calls_per_minute=60, timeout=10.0, transport=None,
+                 forecast_cache=None):
+        """
+        Class request openweathermap.org from the asyncio event loop through a pooled HTTP connection.
+        The parsing is the same as in OpenweathermapParser.
+        :param api_key: str, api_key for api.openweathermap.org
+        :param max_concurrency: int, maximum number of requests in flight (default=20)
+        :param calls_per_minute: int, calls per minute allowed by the API plan (default=60)
+        :param timeout: float, timeout of a request in seconds (default=10.0)
+        :param transport: (httpx.AsyncBaseTransport) transport of the HTTP client, e.g. a stand-in of the service
+         in the benchmarks (default=None, the network)
+        :param forecast_cache: (ForecastCache) cache of the parsed forecasts, it should not be shared with
+         a synchronous parser (default=None, a new cache of this parser)
+        """
+        super().__init__(api_key, timeout=timeout, forecast_cache=forecast_cache)
+        self._client = httpx.AsyncClient(
+            timeout=timeout, transport=transport,
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency))
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.calls_per_minute = calls_per_minute
+        self._rate_limiter = TokenBucket.per_minute(calls_per_minute)
+
+    async def _get(self, url):
+        """Make the GET request within the concurrency and rate limits, record its status code and response time"""
+        async with self._semaphore:
+            await self._rate_limiter.acquire()
+            with UPSTREAM_LATENCY.time():
+                try:
+                    response = await self._client.get(url)
+                except httpx.HTTPError:
+                    UPSTREAM_REQUESTS.labels('error').inc()
+                    raise
+            UPSTREAM_REQUESTS.labels(response.status_code).inc()
+            return response
+
+    async def request_openweathermap_by_city(self, city):
+        """Make API request to openweathermap.org data for given city"""
+        url = self._make_url_get_weather_by_city(city)
+        return await self._get(url)
+
+    async def request_openweathermap_by_latlon(self, lat, lon):
+        """Make API request to openweathermap.org data for given latitude and longitude"""
+        url = self._make_url_get_weather_by_latlon(lat, lon)
+        return await self._get(url)
+
+    async def get_weather_dict(self, lat, lon, max_attempts=10, use_cache=True):
+        """
+        Extracts relevant weather data from the current weather forecast
+        :lat: (float) latitude
+        :lon: (float) longitude
+        :max_attempts: int, maximum number of attempts to make the request (default=10)
+        :use_cache: bool, take the forecast from the forecast cache of the parser if it is there (default=True)
+        :return: (Forecast) parsed forecast or None.
+        """
+        if not use_cache:
+            return await self._fetch_weather_dict(lat, lon, max_attempts)
+        forecast = await self.forecast_cache.get_or_fetch_async(
+            lat, lon, lambda: self._fetch_weather_dict(lat, lon, max_attempts))
+        return forecast if forecast is not None else self._get_last_good_forecast(lat, lon)
+
+    async def _fetch_weather_dict(self, lat, lon, max_attempts):
+        """Request the forecast from openweathermap.org with retries and parse it"""
+        url = self._make_url_get_weather_by_latlon(lat, lon)
+        circuit_breaker = get_circuit_breaker(url)
+        for attempt in range(1, max_attempts + 1):
+            if not circuit_breaker.allow():
+                logger.warning("Circuit to %s is open, skip request: %s, %s", circuit_breaker.name, lat, lon)
+                return None
+            try:
+                response = await self._get(url)
+                forecast, retry = self._check_forecast_response(response, lat, lon, attempt)
+            except httpx.HTTPError as e:
+                logger.warning("Attempt %d: Failed to fetch weather forecast: %r", attempt, e)
+                forecast, retry = None, True
+            except BaseException:
+                # The interrupted request, e.g. a cancelled prefetch, does not keep holding the trial
+                # of the half-open circuit
+                circuit_breaker.release_trial()
+                raise
+            if not retry:
+                circuit_breaker.record_success()
+                return forecast
+            circuit_breaker.record_failure()
+            if attempt < max_attempts:
+                await asyncio.sleep(self._get_backoff(attempt))
+        return None
+
+    async def refresh_weather_dict(self, lat, lon, max_attempts=3):
+        """
+        Request the forecast even if the cached one is fresh and store it in the cache.
+        The request in flight for the same location is awaited instead of making another one
+        :lat: (float) latitude
+        :lon: (float) longitude
+        :max_attempts: int, maximum number of attempts to make the request (default=3)
+        :return: (Forecast) parsed forecast or None.
+        """
+        return await self.forecast_cache.get_or_fetch_async(
+            lat, lon, lambda: self._fetch_weather_dict(lat, lon, max_attempts), force=True)
+
+    async def aclose(self):
+        """Close the pooled connections"""
+        await self._client.aclose()
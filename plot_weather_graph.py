@@ -3,17 +3,25 @@ mpl.use('Agg')  # headless mode
 import matplotlib.pyplot as plt
 from matplotlib.offsetbox import OffsetImage, AnnotationBbox
 from scipy.interpolate import CubicSpline
-from datetime import datetime
 import numpy as np
-import urllib.request
 import io
-from PIL import Image
+from icon_atlas import icon_atlas
+import fast_plot
+
+BACKENDS = ('matplotlib', 'fast')
+PLOT_STEPS = 7  # 3-hour time steps shown on the plot
 
 
 class PlotBuilder:
-    def __init__(self, weather_dict):
-        self.weather_dict = weather_dict
-        pass
+    def __init__(self, forecast, backend='matplotlib'):
+        """
+        :param forecast: (Forecast) parsed forecast, the first PLOT_STEPS time steps are plotted
+        :param backend: str, 'matplotlib' or 'fast' drawing directly into a PIL buffer (default='matplotlib')
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown plot backend {backend}, expected one of {BACKENDS}")
+        self.forecast = forecast.head(PLOT_STEPS)
+        self.backend = backend
 
     @staticmethod
     def smooth_curve(x, y):
@@ -40,21 +48,21 @@ class PlotBuilder:
     @staticmethod
     def get_image_by_icon_id(icon_id):
         """
-        Return image from openweathermap.org for correspondent icon_id
+        Return image of the openweathermap.org icon from the preloaded icon atlas
         :param icon_id: str, e.g. '02n'
-        :return: (np.array), image of the icon
+        :return: (np.array), RGBA image of the icon
         """
-        img_url = f'https://openweathermap.org/img/wn/{icon_id}@2x.png'
-        with urllib.request.urlopen(img_url) as url:
-            img_data = url.read()
-        img = np.array(Image.open(io.BytesIO(img_data)))
-        return img
+        return icon_atlas.get(icon_id)
 
-    def plot_weather_ts(self, show=False):
+    def make_figure(self):
+        """
+        Build the figure with the weather forecast
+        :return: (matplotlib.figure.Figure)
+        """
         # Get smooth curves
-        time_ts_smooth, temp_ts_smooth = self.smooth_curve(self.weather_dict['time_ts'], self.weather_dict['temp_ts'])
-        time_ts_smooth, temp_feels_like_ts_smooth = self.smooth_curve(self.weather_dict['time_ts'],
-                                                                      self.weather_dict['temp_feels_like_ts'])
+        time_ts_smooth, temp_ts_smooth = self.smooth_curve(self.forecast.time_ts, self.forecast.temp_ts)
+        time_ts_smooth, temp_feels_like_ts_smooth = self.smooth_curve(self.forecast.time_ts,
+                                                                      self.forecast.temp_feels_like_ts)
 
         fig, ax = plt.subplots(figsize=(5, 3))
         ax.plot(time_ts_smooth, temp_ts_smooth, label='Real', marker=None)
@@ -62,32 +70,47 @@ class PlotBuilder:
         ax.set_xlabel('Time, h')
         ax.set_ylabel('Temperature, °C')
         ax.legend(loc='upper right', fancybox=True, framealpha=0.5)
-        title_date = datetime.fromtimestamp(self.weather_dict['time_sunrise']).strftime("%d %B %Y")
-        title = f"{self.weather_dict['city']}, {self.weather_dict['country']}, {title_date}"
+        title_date = self.forecast.local_time(self.forecast.time_sunrise).strftime("%d %B %Y")
+        title = f"{self.forecast.city}, {self.forecast.country}, {title_date}"
         ax.set_title(title)
 
         # Label the x_axis
-        hour_label_lst = [datetime.fromtimestamp(timestamp).strftime('%H:00') for timestamp in
-                          self.weather_dict['time_ts']]
-        ax.set_xticks(self.weather_dict['time_ts'])
+        hour_label_lst = [self.forecast.local_time(timestamp).strftime('%H:00') for timestamp in
+                          self.forecast.time_ts]
+        ax.set_xticks(self.forecast.time_ts)
         ax.set_xticklabels(hour_label_lst)
 
         # Fill the area between sunset and sunrise with a dark color
-        time_ts = np.array(self.weather_dict['time_ts'])
-        night_mask = (time_ts >= self.weather_dict['time_sunset']) | (time_ts <= self.weather_dict['time_sunrise'])
-        ax.fill_between(time_ts, min(self.weather_dict['temp_ts']), max(self.weather_dict['temp_ts']), where=night_mask,
+        time_ts = self.forecast.time_ts
+        night_mask = (time_ts >= self.forecast.time_sunset) | (time_ts <= self.forecast.time_sunrise)
+        ax.fill_between(time_ts, self.forecast.temp_ts.min(), self.forecast.temp_ts.max(), where=night_mask,
                         facecolor='black', alpha=0.3)
 
         # Plot icons
-        icon_img_lst = [self.get_image_by_icon_id(icon_id) for icon_id in self.weather_dict['icon_ts']]
+        icon_img_lst = [self.get_image_by_icon_id(icon_id) for icon_id in self.forecast.icon_ts]
         y_center_coord = (ax.get_ylim()[0] + ax.get_ylim()[1]) / 2
-        for x_coord, icon_img in zip(self.weather_dict['time_ts'], icon_img_lst):
+        for x_coord, icon_img in zip(self.forecast.time_ts, icon_img_lst):
             ab = AnnotationBbox(OffsetImage(icon_img, zoom=0.25), (x_coord, y_center_coord), frameon=False)
             ax.add_artist(ab)
+        return fig
 
+    def plot_weather_ts(self, show=False, plot_path='weather.png'):
+        fig = self.make_figure()
         if not show:
             plt.close(fig)
         # Save the plot
-        plot_path = 'weather.png'
         fig.savefig(plot_path, bbox_inches='tight')
         return plot_path
+
+    def render_png(self):
+        """
+        Render the plot in memory
+        :return: (bytes) PNG image
+        """
+        if self.backend == 'fast':
+            return fast_plot.get_renderer().render_png(self.forecast)
+        fig = self.make_figure()
+        plt.close(fig)
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png', bbox_inches='tight')
+        return buffer.getvalue()
@@ -0,0 +1,114 @@
+import asyncio
+from logger import logger
+from rate_limit import TokenBucket
+
+
+class Prefetcher:
+    """
+    Background stage refreshing the forecasts and plots of the distinct locations due in the next minutes,
+    so at delivery time the jobs only send. The upstream calls are paced at a steady rate.
+    """
+    def __init__(self, mailer, scheduler, lookahead=15 * 60, interval=60, calls_per_minute=30):
+        """
+        :param mailer: (WeatherMailer) mailer warming the caches
+        :param scheduler: (DeliveryScheduler) scheduler of the delivery jobs
+        :param lookahead: (float) seconds ahead of the deliveries to prefetch
+        :param interval: (float) seconds between the scans of the schedule
+        :param calls_per_minute: (float) pace of the prefetch requests, it should leave a share of the API plan
+         to the live requests
+        """
+        self.mailer = mailer
+        self.scheduler = scheduler
+        self.lookahead = lookahead
+        self.interval = interval
+        self.calls_per_minute = calls_per_minute
+        self._rate_limiter = TokenBucket.per_minute(calls_per_minute, capacity=1)
+        self._task = None
+        self.prefetched = 0
+        self.failed = 0
+
+    def start(self):
+        """Start the prefetch loop on the running event loop"""
+        if self._task is None:
+            logger.info('Starting forecast prefetcher')
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the prefetch loop"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        while True:
+            try:
+                await self.prefetch_due()
+            except Exception as e:
+                logger.error("Prefetch failed: %r", e)
+            await asyncio.sleep(self.interval)
+
+    def locations_due(self):
+        """
+        Return the distinct locations of the jobs due within the lookahead
+        :return: (dict) {cell: (lat, lon, render)}, render tells if a report is due at the location
+        """
+        locations = {}
+        cache = self.mailer.owmparser.forecast_cache
+        for key in self.scheduler.upcoming(self.lookahead):
+            # Reports are keyed by (chat_id, 'report'), the alerts shared by the chats by ('alert', UTC minute_of_day)
+            if key[0] == 'alert':
+                kind, chat_ids = 'alert', self.mailer.registry.chat_ids_due_at(key[1], 'alert')
+            else:
+                kind, chat_ids = key[1], (key[0],)
+            for chat_id in chat_ids:
+                subscription = self.mailer.registry.get(chat_id)
+                if subscription is None:
+                    continue
+                cell = cache.cell(subscription.lat, subscription.lon)
+                _, _, render = locations.get(cell, (None, None, False))
+                locations[cell] = (subscription.lat, subscription.lon, render or kind == 'report')
+        return locations
+
+    async def prefetch_due(self):
+        """
+        Warm the caches of all the locations due within the lookahead. The refreshes are started at the steady rate,
+        the requests and the renders run in the background, so they do not hold back the next refreshes
+        """
+        locations = self.locations_due()
+        if not locations:
+            return
+        cache = self.mailer.owmparser.forecast_cache
+        # Fresh enough forecasts are not requested again, so the limiter is taken only on refresh
+        n_refresh = sum(cache.expires_in(lat, lon) <= self.lookahead for lat, lon, _ in locations.values())
+        logger.info(f"Prefetching {len(locations)} locations, {n_refresh} of them are refreshed")
+        pass_time = n_refresh / self.calls_per_minute * 60
+        if pass_time > self.lookahead:
+            logger.warning(f"Refreshing {n_refresh} forecasts at {self.calls_per_minute} calls per minute takes "
+                           f"{pass_time:.0f} s, more than the lookahead of {self.lookahead} s, "
+                           f"some deliveries will request their forecast")
+        tasks = []
+        try:
+            for lat, lon, render in locations.values():
+                if cache.expires_in(lat, lon) <= self.lookahead:
+                    await self._rate_limiter.acquire()
+                tasks.append(asyncio.create_task(self._prefetch(lat, lon, render)))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _prefetch(self, lat, lon, render):
+        """Warm the caches of the location and count the result"""
+        try:
+            prefetched = await self.mailer.prefetch(lat, lon, min_ttl=self.lookahead, render=render)
+        except Exception as e:
+            logger.error("Prefetch of %s, %s failed: %r", lat, lon, e)
+            prefetched = False
+        if prefetched:
+            self.prefetched += 1
+        else:
+            self.failed += 1
@@ -0,0 +1,62 @@
+import asyncio
+from time import monotonic
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter for the asyncio event loop.
+    Tokens are reserved in order of the calls, so the waiting callers are served first come, first served.
+    """
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: (float) tokens added per second
+        :param capacity: (float) maximum burst of tokens (default=max(rate, 1))
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated_at = monotonic()
+        self._paused_until = 0
+
+    @classmethod
+    def per_minute(cls, calls_per_minute, capacity=None):
+        """Make a bucket allowing calls_per_minute calls on average"""
+        return cls(calls_per_minute / 60, capacity)
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def reserve(self, tokens=1):
+        """
+        Take the tokens, going into debt if there are not enough of them
+        :param tokens: (float) number of tokens
+        :return: (float) seconds to wait until the tokens are available
+        """
+        self._refill()
+        self._tokens -= tokens
+        return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def pause(self, seconds):
+        """
+        Empty the bucket for the given time, e.g. when the server asks to retry later.
+        The callers already waiting in acquire wait for the end of the pause too.
+        :param seconds: (float) duration of the pause
+        """
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+    @property
+    def is_full(self):
+        self._refill()
+        return self._tokens >= self.capacity
+
+    async def acquire(self, tokens=1):
+        """Wait until the tokens are available and take them"""
+        delay = self.reserve(tokens)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            # The reservations made before a pause were dropped with the tokens, so they are made again
+            delay = self.reserve(tokens) if self._paused_until > monotonic() else 0
@@ -0,0 +1,167 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future
+from threading import Lock
+from forecast_cache import quantize_latlon
+
+
+class RenderedPlot:
+    """
+    Rendered forecast plot. Once the plot is uploaded to Telegram, the file_id is sent instead of the bytes.
+    """
+    __slots__ = ('png', 'file_id')
+
+    def __init__(self, png):
+        """
+        :param png: (bytes) PNG image of the plot
+        """
+        self.png = png
+        self.file_id = None
+
+    @property
+    def photo(self):
+        """Return the Telegram file_id if the plot was uploaded, otherwise the PNG bytes"""
+        png = self.png  # read before file_id, the bytes are released only after file_id is set
+        return self.file_id if self.file_id is not None else png
+
+
+class RenderCache:
+    """
+    LRU cache of the rendered plots keyed on the forecast location cell and timestamps.
+    Concurrent misses for the same forecast wait for a single render.
+    get_or_render serves threads, get_or_render_async serves the event loop; one cache should be used by one of them.
+    """
+    def __init__(self, max_size=1000):
+        """
+        :param max_size: (int) maximum number of cached plots
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(forecast):
+        """
+        Return the identity of the parsed forecast
+        :param forecast: (Forecast) parsed forecast
+        :return: (tuple)
+        """
+        return quantize_latlon(forecast.lat, forecast.lon), forecast.time_ts.tobytes()
+
+    def get_or_render(self, forecast, render):
+        """
+        Return the cached plot of the forecast or render it
+        :param forecast: (Forecast) parsed forecast
+        :param render: callable without arguments returning PNG bytes
+        :return: (RenderedPlot)
+        """
+        key = self.key(forecast)
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return entry
+                future = self._in_flight.get(key)
+                if future is None:
+                    self.misses += 1
+                    future = Future()
+                    self._in_flight[key] = future
+                    break
+                self.hits += 1
+            try:
+                return future.result()
+            except CancelledError:
+                pass  # the owner of the render was interrupted, the plot is rendered again
+
+        try:
+            entry = RenderedPlot(render())
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        except BaseException:
+            with self._lock:
+                del self._in_flight[key]
+            future.cancel()
+            raise
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            del self._in_flight[key]
+        future.set_result(entry)
+        return entry
+
+    async def get_or_render_async(self, forecast, render):
+        """
+        Return the cached plot of the forecast or render it on the event loop
+        :param forecast: (Forecast) parsed forecast
+        :param render: coroutine function without arguments returning PNG bytes
+        :return: (RenderedPlot)
+        """
+        key = self.key(forecast)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+        while True:
+            future = self._in_flight.get(key)
+            if future is None:
+                break
+            self.hits += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # this caller is cancelled
+                # The owner of the render was cancelled, not this caller, so the plot is rendered again
+                entry = self._entries.get(key)
+                if entry is not None:
+                    return entry
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            entry = RenderedPlot(await render())
+        except Exception as e:
+            del self._in_flight[key]
+            future.set_exception(e)
+            future.exception()  # mark as retrieved if nobody is waiting
+            raise
+        except BaseException:
+            # The cancellation of the owner is not passed to the waiters, they render the plot again
+            del self._in_flight[key]
+            future.cancel()
+            raise
+        self._entries[key] = entry
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        del self._in_flight[key]
+        future.set_result(entry)
+        return entry
+
+    @staticmethod
+    def remember_file_id(entry, file_id):
+        """
+        Store the Telegram file_id of the uploaded plot and release the PNG bytes
+        :param entry: (RenderedPlot)
+        :param file_id: (str) file_id of the largest uploaded photo size
+        """
+        if entry.file_id is None:
+            entry.file_id = file_id
+            entry.png = None
+
+    def stats(self):
+        """Return the hit/miss counters"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
@@ -0,0 +1,113 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from forecast import Forecast
+from logger import logger
+from metrics import RENDER_LATENCY
+
+
+def _init_worker():
+    """Import the plotting stack and map the icons once per worker process"""
+    import plot_weather_graph  # noqa: F401, imports matplotlib and scipy
+    import fast_plot
+    from icon_atlas import icon_atlas
+    # The pack is built by the parent process. If it failed, the icons are downloaded by the first render
+    # rather than here, a failing initializer breaks the whole pool
+    if os.path.exists(icon_atlas.pack_path):
+        icon_atlas.load()
+    fast_plot.get_renderer()
+
+
+def _warm_up():
+    """Do nothing, the worker process is ready once its initializer has run"""
+
+
+def _render_png(forecast_bytes, backend):
+    from plot_weather_graph import PlotBuilder
+    return PlotBuilder(Forecast.from_bytes(forecast_bytes), backend).render_png()
+
+
+class RenderPool:
+    """
+    Pool of worker processes rendering the forecast plots to PNG bytes off the event loop.
+    """
+    def __init__(self, max_workers=None):
+        """
+        :param max_workers: int, number of worker processes (default=number of cores)
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor = None
+        self._start_lock = asyncio.Lock()
+
+    def start(self):
+        """Start the worker processes, the icon pack should exist, see start_async"""
+        if self._executor is None:
+            logger.info(f'Starting {self.max_workers} render workers')
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_init_worker)
+
+    async def start_async(self):
+        """Download the icon pack once in this process and start the worker processes, they only map the pack"""
+        if self._executor is not None:
+            return
+        async with self._start_lock:
+            if self._executor is not None:
+                return
+            from icon_atlas import icon_atlas
+            try:
+                await asyncio.to_thread(icon_atlas.build_pack)
+            except Exception as e:
+                logger.error(f"Failed to download the weather icons, the render workers will retry: {e!r}")
+            self.start()
+
+    def _drop_broken(self, executor, e):
+        """Forget the pool whose worker died, the next render starts a new one"""
+        if self._executor is executor:
+            logger.error(f"Render pool is broken, restarting it: {e!r}")
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def shutdown(self):
+        """Stop the worker processes"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def warm_up(self, delay=0):
+        """
+        Start all the worker processes and load the plotting stack in them, so the first render does not wait for it
+        :param delay: (float) seconds to wait before, e.g. to let the bot start answering first
+        """
+        await asyncio.sleep(delay)
+        await self.start_async()
+        executor = self._executor
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.gather(*(loop.run_in_executor(executor, _warm_up) for _ in range(self.max_workers)))
+        except BrokenProcessPool as e:
+            self._drop_broken(executor, e)
+            return
+        logger.info('Render workers are ready')
+
+    async def render_png(self, forecast, backend='matplotlib'):
+        """
+        Render the plot of the forecast in a worker process, the forecast is sent to it serialized
+        :param forecast: (Forecast) parsed forecast
+        :param backend: str, plot backend of PlotBuilder
+        :return: (bytes) PNG image
+        """
+        for attempt in (1, 2):
+            await self.start_async()
+            executor = self._executor
+            try:
+                with RENDER_LATENCY.labels(backend).time():
+                    return await asyncio.get_running_loop().run_in_executor(executor, _render_png,
+                                                                            forecast.to_bytes(), backend)
+            except BrokenProcessPool as e:
+                # The render is tried once more in a new pool
+                self._drop_broken(executor, e)
+                if attempt == 2:
+                    raise
@@ -0,0 +1,340 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from bisect import bisect
+from telegram import Bot
+from telegram.request import HTTPXRequest
+import metrics
+from delivery_pipeline import DeliveryPipeline
+from forecast_cache import quantize_latlon
+from logger import log_to_own_file, logger, stop_logging
+from openweathermap_parser import AsyncOpenweathermapParser
+from sqlite_persistence import SQLitePersistence
+
+SHARD_LOG_FILE_NAME = 'logs.shard-{shard_id}.log'
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping the keys, e.g. the grid cells of the locations, to the shards. Each shard has
+    many points on the ring, so adding a shard to N shards moves only about 1/(N+1) of the keys, all of them
+    to the new shard.
+    """
+    def __init__(self, shards=(), replicas=100):
+        """
+        :param shards: iterable of the shard ids, e.g. range(4)
+        :param replicas: int, number of points of each shard on the ring
+        """
+        self.replicas = replicas
+        self._hashes = []
+        self._shards = []
+        for shard in shards:
+            self.add(shard)
+
+    def __len__(self):
+        return len(set(self._shards))
+
+    @staticmethod
+    def _hash(key):
+        """Return the point of the key on the ring, the same in all the processes unlike hash()"""
+        return int.from_bytes(hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def add(self, shard):
+        """Add the points of the shard"""
+        for replica in range(self.replicas):
+            point = self._hash(f"{shard}:{replica}")
+            i = bisect(self._hashes, point)
+            self._hashes.insert(i, point)
+            self._shards.insert(i, shard)
+
+    def remove(self, shard):
+        """Remove the points of the shard, its chats move to the next points"""
+        points = [(point, other) for point, other in zip(self._hashes, self._shards) if other != shard]
+        self._hashes = [point for point, _ in points]
+        self._shards = [other for _, other in points]
+
+    def shard_of(self, key):
+        """
+        Return the shard owning the key
+        :param key: key with the same str() in all the processes, e.g. the grid cell (lat, lon)
+        """
+        if not self._hashes:
+            raise LookupError("The hash ring has no shards")
+        return self._shards[bisect(self._hashes, self._hash(key)) % len(self._hashes)]
+
+    def shard_of_location(self, lat, lon):
+        """
+        Return the shard delivering to the chats at the location. The chats of a grid cell of ForecastCache
+        go to the same shard, so the forecast and the plot of the cell are fetched and rendered once
+        :param lat: (float) latitude
+        :param lon: (float) longitude
+        """
+        return self.shard_of(quantize_latlon(lat, lon))
+
+
+class ShardPool:
+    """
+    Delivery shards running in worker processes, each shard delivers to the chats whose location cell it owns
+    on the hash ring. The front process forwards the settings changes to the owning shard through its IPC queue,
+    a chat moved to a cell of another shard is released by its previous shard.
+    The shards restore their subscriptions from the shared SQLite database.
+    It has subscribe and unsubscribe of WeatherMailer, so UIHandler uses it as the mailer.
+    """
+    def __init__(self, n_shards, bot_api_key, openweathermap_api_key, db_path, forecast_cache=None,
+                 owm_calls_per_minute=60, metrics_port=None, make_bot_request=None, make_owm_transport=None,
+                 store=None, **pipeline_options):
+        """
+        :param n_shards: int, number of the shard processes
+        :param bot_api_key: str, token of the Telegram bot
+        :param openweathermap_api_key: str, api_key for api.openweathermap.org
+        :param db_path: str, path to the SQLite database of SQLitePersistence
+        :param forecast_cache: (ForecastCache) forecasts of the front process, their UTC offsets are sent
+         with the settings (default=None)
+        :param owm_calls_per_minute: (float) calls per minute of the API plan left to the shards, each one gets
+         an equal share of it
+        :param metrics_port: int, the shard i serves its metrics on metrics_port + 1 + i (default=None, no endpoint)
+        :param make_bot_request: callable without arguments making the telegram.request.BaseRequest of the shard,
+         it is pickled by reference, e.g. a stand-in of Telegram in the benchmarks (default=None, the network)
+        :param make_owm_transport: callable without arguments making the httpx transport of the shard
+         (default=None, the network)
+        :param store: (SQLitePersistence) store of the subscriptions, it tells the shard of the chats subscribed
+         before the start (default=None, they are unsubscribed on all the shards)
+        :param pipeline_options: keyword arguments of DeliveryPipeline. The render_workers are shared by the shards,
+         each one gets cores / n_shards of them by default
+        """
+        self.n_shards = n_shards
+        self.ring = HashRing(range(n_shards))
+        self.forecast_cache = forecast_cache
+        self.store = store
+        self._owners = {}  # chat_id: shard of the chats subscribed since the start
+        if pipeline_options.get('render_workers') is None:
+            pipeline_options['render_workers'] = max(1, (os.cpu_count() or 1) // n_shards)
+        self.config = {'n_shards': n_shards, 'bot_api_key': bot_api_key,
+                       'openweathermap_api_key': openweathermap_api_key, 'db_path': db_path,
+                       'owm_calls_per_minute': owm_calls_per_minute, 'metrics_port': metrics_port,
+                       'make_bot_request': make_bot_request, 'make_owm_transport': make_owm_transport,
+                       'pipeline_options': pipeline_options}
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue() for _ in range(n_shards)]
+        self._results = self._context.Queue()
+        self._processes = [None] * n_shards
+        self._watcher = None
+        self._stats_request = 0
+
+    def start(self, watch_interval=10):
+        """
+        Start the shard processes and the watcher restarting them on the running event loop
+        :param watch_interval: (float) seconds between the checks of the shard processes
+        """
+        logger.info(f'Starting {self.n_shards} delivery shards')
+        for shard_id in range(self.n_shards):
+            self._start_shard(shard_id)
+        self._watcher = asyncio.create_task(self._watch(watch_interval))
+
+    async def _watch(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.restart_dead()
+
+    def _start_shard(self, shard_id):
+        # The shards start render processes, so they are not daemonic and are stopped by stop()
+        process = self._context.Process(target=run_shard, name=f'delivery-shard-{shard_id}',
+                                        args=(shard_id, self.config, self._queues[shard_id], self._results))
+        process.start()
+        self._processes[shard_id] = process
+
+    def restart_dead(self):
+        """
+        Start again the shards which exited, the settings sent to them meanwhile are kept in their queues
+        :return: int, number of the restarted shards
+        """
+        dead = [shard_id for shard_id, process in enumerate(self._processes)
+                if process is not None and not process.is_alive()]
+        for shard_id in dead:
+            logger.error(f'Delivery shard {shard_id} exited with code {self._processes[shard_id].exitcode}, '
+                         f'restarting it')
+            self._start_shard(shard_id)
+        return len(dead)
+
+    async def stop(self, timeout=30):
+        """
+        Stop the shards, they wait for the jobs being dispatched, the messages left in their delivery queues are dropped
+        :param timeout: (float) seconds to wait for a shard before it is terminated
+        """
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+        for shard_queue in self._queues:
+            shard_queue.put(('stop',))
+        for shard_id, process in enumerate(self._processes):
+            if process is None:
+                continue
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                logger.error(f'Delivery shard {shard_id} did not stop in {timeout} s, terminating it')
+                process.terminate()
+                await asyncio.to_thread(process.join)
+            self._processes[shard_id] = None
+
+    def _owner(self, chat_id):
+        """Return the shard delivering to the chat, None if it is unknown"""
+        shard_id = self._owners.get(chat_id)
+        if shard_id is None and self.store is not None:
+            subscription = self.store.get_subscription(chat_id)
+            if subscription is not None:
+                shard_id = self.ring.shard_of_location(subscription.lat, subscription.lon)
+        return shard_id
+
+    def subscribe(self, chat_id, lat, lon, report_time, alert_time):
+        """
+        Send the settings of the chat to the shard of its location, see WeatherMailer.subscribe.
+        The previous shard of the chat releases it keeping it in the database written by the new shard
+        """
+        settings = {'lat': lat, 'lon': lon, 'report_time': report_time, 'alert_time': alert_time}
+        forecast = self.forecast_cache.get_stale(lat, lon) if self.forecast_cache is not None else None
+        if forecast is not None:
+            settings['tz_offset'] = forecast.timezone
+        shard_id = self.ring.shard_of_location(lat, lon)
+        previous_shard_id = self._owner(chat_id)
+        if previous_shard_id not in (None, shard_id):
+            self._queues[previous_shard_id].put(('release', chat_id))
+        self._queues[shard_id].put(('subscribe', chat_id, settings))
+        self._owners[chat_id] = shard_id
+
+    def unsubscribe(self, chat_id):
+        """Send the removal of the subscription of the chat to its shard, to all the shards if it is unknown"""
+        shard_id = self._owner(chat_id)
+        self._owners.pop(chat_id, None)
+        for shard_queue in (self._queues if shard_id is None else [self._queues[shard_id]]):
+            shard_queue.put(('unsubscribe', chat_id))
+
+    async def stats(self, timeout=5):
+        """
+        Return the delivery counters of the shards which answered within the timeout
+        :return: (list) dicts of DeliveryPipeline.stats with the shard id
+        """
+        self._stats_request += 1
+        for shard_queue in self._queues:
+            shard_queue.put(('stats', self._stats_request))
+        results = {}
+        deadline = time.monotonic() + timeout
+        while len(results) < self.n_shards and time.monotonic() < deadline:
+            try:
+                result = await asyncio.to_thread(self._results.get, True, max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            # The late answers to the previous requests are skipped
+            if result.pop('request') == self._stats_request:
+                results[result['shard']] = result
+        return [results[shard_id] for shard_id in sorted(results)]
+
+
+class DeliveryShard:
+    """
+    Delivery pipeline of one shard process. It applies the settings changes received from the front process.
+    """
+    def __init__(self, shard_id, config, settings_queue, results_queue):
+        """
+        :param shard_id: int, id of the shard on the hash ring
+        :param config: (dict) settings of ShardPool
+        :param settings_queue: (multiprocessing.Queue) commands of the front process
+        :param results_queue: (multiprocessing.Queue) answers to the front process
+        """
+        self.shard_id = shard_id
+        self.config = config
+        self.settings_queue = settings_queue
+        self.results_queue = results_queue
+        self.ring = HashRing(range(config['n_shards']))
+        self.pipeline = None
+
+    def owns(self, subscription):
+        """Tell if the shard delivers to the chat of the subscription"""
+        return self.ring.shard_of_location(subscription.lat, subscription.lon) == self.shard_id
+
+    async def run(self):
+        """Run the delivery until the front process sends stop or exits"""
+        config = self.config
+        n_shards = config['n_shards']
+        make_bot_request = config['make_bot_request']
+        request = make_bot_request() if make_bot_request is not None else \
+            HTTPXRequest(connection_pool_size=DeliveryPipeline.delivery_workers + 1)
+        bot = Bot(config['bot_api_key'], request=request)
+        make_owm_transport = config['make_owm_transport']
+        owmparser = AsyncOpenweathermapParser(config['openweathermap_api_key'],
+                                              calls_per_minute=config['owm_calls_per_minute'] / n_shards,
+                                              transport=make_owm_transport() if make_owm_transport else None)
+        # Only the subscriptions table of the database is used by the shard
+        store = SQLitePersistence(filepath=config['db_path'])
+        self.pipeline = DeliveryPipeline(bot, owmparser, store, share=1 / n_shards,
+                                         owns=self.owns,
+                                         **config['pipeline_options'])
+        self.pipeline.register_metrics()
+        metrics_server = None
+        if config['metrics_port'] is not None:
+            metrics_server = metrics.MetricsServer(port=config['metrics_port'] + 1 + self.shard_id)
+
+        await bot.initialize()
+        try:
+            await self.pipeline.start()
+            if metrics_server is not None:
+                await metrics_server.start()
+            logger.info(f'Delivery shard {self.shard_id} of {n_shards} is running')
+            while True:
+                command = await asyncio.to_thread(self._next_command)
+                if command is None:
+                    continue
+                if command[0] == 'stop':
+                    break
+                self.handle(command)
+        finally:
+            if metrics_server is not None:
+                await metrics_server.stop()
+            await self.pipeline.scheduler.join()
+            await self.pipeline.stop()
+            await bot.shutdown()
+            store.close()
+            logger.info(f'Delivery shard {self.shard_id} stopped')
+
+    def _next_command(self, timeout=1.0):
+        """Return the next command, None on timeout, ('stop',) if the front process exited"""
+        try:
+            return self.settings_queue.get(timeout=timeout)
+        except queue.Empty:
+            parent = multiprocessing.parent_process()
+            return ('stop',) if parent is not None and not parent.is_alive() else None
+
+    def handle(self, command):
+        """
+        Apply the command of the front process
+        :param command: (tuple) ('subscribe', chat_id, settings), ('unsubscribe', chat_id), ('release', chat_id)
+         of a chat moved to another shard or ('stats', request)
+        """
+        mailer = self.pipeline.mailer
+        if command[0] == 'subscribe':
+            _, chat_id, settings = command
+            mailer.subscribe(chat_id, **settings)
+        elif command[0] == 'unsubscribe':
+            mailer.unsubscribe(command[1])
+        elif command[0] == 'release':
+            mailer.unsubscribe(command[1], keep_stored=True)
+        elif command[0] == 'stats':
+            self.results_queue.put(dict(self.pipeline.stats(), shard=self.shard_id, request=command[1]))
+        else:
+            logger.error(f'Delivery shard {self.shard_id} got unknown command {command!r}')
+
+
+def run_shard(shard_id, config, settings_queue, results_queue):
+    """Entry point of the shard process"""
+    # Ctrl+C reaches the whole process group, the shard is stopped by the front process instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The shard rotates its own file in a background thread, the delivery does not wait for the disk
+    log_to_own_file(SHARD_LOG_FILE_NAME.format(shard_id=shard_id))
+    try:
+        asyncio.run(DeliveryShard(shard_id, config, settings_queue, results_queue).run())
+    finally:
+        stop_logging()
@@ -0,0 +1,269 @@
+import json
+import os
+import pickle
+import sqlite3
+from threading import Lock
+from telegram.ext import BasePersistence, PersistenceInput
+from forecast_cache import quantize_latlon
+from subscriptions import Subscription
+from logger import logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY CHECK (id = 0), data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (name, key));
+CREATE TABLE IF NOT EXISTS subscriptions (
+    chat_id INTEGER PRIMARY KEY,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    report_minute INTEGER NOT NULL,
+    alert_minute INTEGER NOT NULL,
+    tz_offset INTEGER NOT NULL,
+    cell_lat INTEGER NOT NULL,
+    cell_lon INTEGER NOT NULL,
+    report_utc_minute INTEGER NOT NULL DEFAULT 0,
+    alert_utc_minute INTEGER NOT NULL DEFAULT 0);
+"""
+# Created after the UTC minute columns are added to the databases made before them
+INDEXES = """
+DROP INDEX IF EXISTS subscriptions_report_minute;
+DROP INDEX IF EXISTS subscriptions_alert_minute;
+CREATE INDEX IF NOT EXISTS subscriptions_report_utc_minute ON subscriptions (report_utc_minute);
+CREATE INDEX IF NOT EXISTS subscriptions_alert_utc_minute ON subscriptions (alert_utc_minute);
+CREATE INDEX IF NOT EXISTS subscriptions_cell ON subscriptions (cell_lat, cell_lon);
+"""
+
+
+class _PickleUnpickler(pickle.Unpickler):
+    """Unpickler of the PicklePersistence file, the bot references saved by PTB are replaced by None"""
+
+    def persistent_load(self, pid):
+        return None
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Persistence of the bot in SQLite in WAL mode. Unlike PicklePersistence only the changed rows are written.
+    It also stores the subscriptions indexed by the UTC minute of the deliveries and the location cell.
+    """
+    def __init__(self, filepath="conversationbot.sqlite3", update_interval=60):
+        """
+        :param filepath: str, path to the database file
+        :param update_interval: float, seconds between the writes of the changed data by the Application
+        """
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.filepath = filepath
+        self._conn = sqlite3.connect(filepath, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._add_utc_minutes()
+        self._conn.executescript(INDEXES)
+        self._lock = Lock()
+        # Serialized rows as they are in the database, to skip writing the unchanged ones
+        self._user_rows = {}
+        self._chat_rows = {}
+        self._bot_row = None
+
+    def _add_utc_minutes(self):
+        """Add the UTC minute columns to the subscriptions table made without them and fill them"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(subscriptions)")}
+        if 'report_utc_minute' in columns:
+            return
+        logger.info(f"Adding the UTC minutes of the deliveries to {self.filepath}")
+        self._conn.execute("BEGIN")
+        self._conn.execute("ALTER TABLE subscriptions ADD COLUMN report_utc_minute INTEGER NOT NULL DEFAULT 0")
+        self._conn.execute("ALTER TABLE subscriptions ADD COLUMN alert_utc_minute INTEGER NOT NULL DEFAULT 0")
+        rows = self._conn.execute(
+            "SELECT chat_id, lat, lon, report_minute, alert_minute, tz_offset FROM subscriptions").fetchall()
+        self._conn.executemany(
+            "UPDATE subscriptions SET report_utc_minute = ?, alert_utc_minute = ? WHERE chat_id = ?",
+            [(s.report_utc_minute, s.alert_utc_minute, s.chat_id) for s in (Subscription(*row) for row in rows)])
+        self._conn.execute("COMMIT")
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._conn.execute(sql, parameters)
+
+    @staticmethod
+    def _dumps(data):
+        return json.dumps(data, ensure_ascii=False, sort_keys=True)
+
+    def _load_rows(self, table, key_column, rows_cache):
+        data = {}
+        for key, row in self._execute(f"SELECT {key_column}, data FROM {table}"):
+            rows_cache[key] = row
+            data[key] = json.loads(row)
+        return data
+
+    def _write_row(self, table, key_column, rows_cache, key, data):
+        row = self._dumps(data)
+        if rows_cache.get(key) == row:
+            return
+        rows_cache[key] = row
+        self._execute(f"INSERT OR REPLACE INTO {table} ({key_column}, data) VALUES (?, ?)", (key, row))
+
+    def _drop_row(self, table, key_column, rows_cache, key):
+        rows_cache.pop(key, None)
+        self._execute(f"DELETE FROM {table} WHERE {key_column} = ?", (key,))
+
+    async def get_user_data(self):
+        return self._load_rows("user_data", "user_id", self._user_rows)
+
+    async def get_chat_data(self):
+        return self._load_rows("chat_data", "chat_id", self._chat_rows)
+
+    async def get_bot_data(self):
+        row = self._execute("SELECT data FROM bot_data WHERE id = 0").fetchone()
+        self._bot_row = row[0] if row else None
+        return json.loads(self._bot_row) if row else {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        rows = self._execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            self._execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(key)))
+        else:
+            self._execute("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                          (name, json.dumps(key), json.dumps(new_state)))
+
+    async def update_user_data(self, user_id, data):
+        self._write_row("user_data", "user_id", self._user_rows, user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._write_row("chat_data", "chat_id", self._chat_rows, chat_id, data)
+
+    async def update_bot_data(self, data):
+        row = self._dumps(data)
+        if row != self._bot_row:
+            self._bot_row = row
+            self._execute("INSERT OR REPLACE INTO bot_data (id, data) VALUES (0, ?)", (row,))
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        self._drop_row("chat_data", "chat_id", self._chat_rows, chat_id)
+
+    async def drop_user_data(self, user_id):
+        self._drop_row("user_data", "user_id", self._user_rows, user_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """
+        Checkpoint the WAL into the database file. The connection stays open,
+        the Application flushes before post_shutdown and the subscriptions may still be written, see close
+        """
+        with self._lock:
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        """Checkpoint the WAL into the database file and close it"""
+        logger.info(f"Closing {self.filepath}")
+        with self._lock:
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._conn.close()
+
+    def import_pickle(self, filepath):
+        """
+        Copy the user, chat and bot data and the conversations of PicklePersistence into the empty database once.
+        The old bot kept no schedules over a restart, so the users start the mailing again with /start
+        :param filepath: str, path to the single file of PicklePersistence, e.g. "conversationbot"
+        :return: bool, if the data was imported
+        """
+        if not os.path.exists(filepath):
+            return False
+        for table in ("user_data", "chat_data", "bot_data", "conversations"):
+            if self._execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is not None:
+                return False
+        try:
+            with open(filepath, "rb") as f:
+                data = _PickleUnpickler(f).load()
+        except Exception as e:
+            logger.error(f"Failed to read {filepath} of PicklePersistence: {e!r}")
+            return False
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT INTO user_data (user_id, data) VALUES (?, ?)",
+                                   [(key, self._dumps(value)) for key, value in (data.get("user_data") or {}).items()])
+            self._conn.executemany("INSERT INTO chat_data (chat_id, data) VALUES (?, ?)",
+                                   [(key, self._dumps(value)) for key, value in (data.get("chat_data") or {}).items()])
+            if data.get("bot_data"):
+                self._conn.execute("INSERT INTO bot_data (id, data) VALUES (0, ?)", (self._dumps(data["bot_data"]),))
+            self._conn.executemany("INSERT INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                                   [(name, json.dumps(list(key)), json.dumps(state))
+                                    for name, states in (data.get("conversations") or {}).items()
+                                    for key, state in states.items() if state is not None])
+            self._conn.execute("COMMIT")
+        logger.info(f"Imported {len(data.get('user_data') or {})} users of PicklePersistence from {filepath}")
+        return True
+
+    def save_subscription(self, subscription):
+        """
+        Insert or update the subscription
+        :param subscription: (Subscription)
+        """
+        cell_lat, cell_lon = quantize_latlon(subscription.lat, subscription.lon)
+        self._execute("INSERT OR REPLACE INTO subscriptions "
+                      "(chat_id, lat, lon, report_minute, alert_minute, tz_offset, cell_lat, cell_lon, "
+                      "report_utc_minute, alert_utc_minute) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                      (subscription.chat_id, subscription.lat, subscription.lon, subscription.report_minute,
+                       subscription.alert_minute, subscription.tz_offset, cell_lat, cell_lon,
+                       subscription.report_utc_minute, subscription.alert_utc_minute))
+
+    def get_subscription(self, chat_id):
+        """
+        Return the subscription of the chat
+        :param chat_id: The ID of the Telegram chat
+        :return: (Subscription) or None if the chat is not subscribed
+        """
+        row = self._execute("SELECT chat_id, lat, lon, report_minute, alert_minute, tz_offset FROM subscriptions "
+                            "WHERE chat_id = ?", (chat_id,)).fetchone()
+        return Subscription(*row) if row is not None else None
+
+    def delete_subscription(self, chat_id):
+        """Delete the subscription of the chat"""
+        self._execute("DELETE FROM subscriptions WHERE chat_id = ?", (chat_id,))
+
+    def iter_subscriptions(self, batch_size=1000):
+        """
+        Stream all the subscriptions without loading the whole table at once
+        :param batch_size: int, number of rows fetched at once
+        :return: generator of Subscription
+        """
+        cursor = self._conn.cursor()
+        with self._lock:
+            cursor.execute("SELECT chat_id, lat, lon, report_minute, alert_minute, tz_offset FROM subscriptions")
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield Subscription(*row)
+
+    def chat_ids_due_at(self, minute_of_day, kind='report'):
+        """
+        Return the chats with the delivery at the UTC minute of the day, like SubscriptionRegistry.chat_ids_due_at
+        :param minute_of_day: int, e.g. 510 for "08:30" UTC
+        :param kind: str, 'report' or 'alert'
+        :return: (list) chat ids
+        """
+        column = {'report': 'report_utc_minute', 'alert': 'alert_utc_minute'}[kind]
+        rows = self._execute(f"SELECT chat_id FROM subscriptions WHERE {column} = ?", (minute_of_day,))
+        return [chat_id for chat_id, in rows]
@@ -0,0 +1,163 @@
+MINUTES_PER_DAY = 24 * 60
+DELIVERY_KINDS = ('report', 'alert')
+
+
+def time_to_minute(time_str):
+    """
+    Convert time to minute of the day
+    :param time_str: str, e.g. "08:30"
+    :return: (int) e.g. 510
+    """
+    hour, minute = map(int, time_str.split(':'))
+    return hour * 60 + minute
+
+
+def minute_to_time(minute_of_day):
+    """
+    Convert minute of the day to time
+    :param minute_of_day: (int) e.g. 510
+    :return: str, e.g. "08:30"
+    """
+    return f"{minute_of_day // 60:02d}:{minute_of_day % 60:02d}"
+
+
+class Subscription:
+    """
+    Delivery settings of a chat
+    """
+    __slots__ = ('chat_id', 'lat', 'lon', 'report_minute', 'alert_minute', 'tz_offset')
+
+    def __init__(self, chat_id, lat, lon, report_minute, alert_minute, tz_offset=0):
+        """
+        :param chat_id: (int) The ID of the Telegram chat
+        :param lat: (float) latitude
+        :param lon: (float) longitude
+        :param report_minute: (int) minute of the day of the weather report in the local time of the location
+        :param alert_minute: (int) minute of the day of the rain alert in the local time of the location
+        :param tz_offset: (int) shift of the location time zone from UTC in seconds
+        """
+        self.chat_id = chat_id
+        self.lat = lat
+        self.lon = lon
+        self.report_minute = report_minute
+        self.alert_minute = alert_minute
+        self.tz_offset = tz_offset
+
+    @property
+    def report_utc_minute(self):
+        """Return the UTC minute of the day of the weather report"""
+        return (self.report_minute - self.tz_offset // 60) % MINUTES_PER_DAY
+
+    @property
+    def alert_utc_minute(self):
+        """Return the UTC minute of the day of the rain alert"""
+        return (self.alert_minute - self.tz_offset // 60) % MINUTES_PER_DAY
+
+    def __repr__(self):
+        return f"Subscription({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+
+class SubscriptionRegistry:
+    """
+    Subscriptions of all the chats keyed by chat_id, the changes are written through to the store if it is given.
+    The chats are also indexed by the UTC minute of the day of each delivery kind.
+    """
+    def __init__(self, store=None):
+        """
+        :param store: object with save_subscription(subscription) and delete_subscription(chat_id) methods,
+         e.g. SQLitePersistence (default=None)
+        """
+        self._subscriptions = {}
+        self._due_at = {kind: {} for kind in DELIVERY_KINDS}  # {kind: {UTC minute_of_day: set of chat_id}}
+        self.store = store
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._subscriptions
+
+    def __iter__(self):
+        return iter(self._subscriptions.values())
+
+    def get(self, chat_id):
+        """
+        Return the subscription of the chat or None
+        :param chat_id: (int) The ID of the Telegram chat
+        """
+        return self._subscriptions.get(chat_id)
+
+    def chat_ids_due_at(self, minute_of_day, kind='report'):
+        """
+        Return the chats with the delivery at the UTC minute of the day
+        :param minute_of_day: int, e.g. 510 for "08:30" UTC
+        :param kind: str, 'report' or 'alert'
+        :return: (list) chat ids
+        """
+        return list(self._due_at[kind].get(minute_of_day, ()))
+
+    def _index(self, subscription):
+        for kind in DELIVERY_KINDS:
+            self._due_at[kind].setdefault(getattr(subscription, f'{kind}_utc_minute'), set()).add(subscription.chat_id)
+
+    def _unindex(self, subscription):
+        for kind in DELIVERY_KINDS:
+            minute_of_day = getattr(subscription, f'{kind}_utc_minute')
+            chat_ids = self._due_at[kind].get(minute_of_day)
+            if chat_ids is not None:
+                chat_ids.discard(subscription.chat_id)
+                if not chat_ids:
+                    del self._due_at[kind][minute_of_day]
+
+    def upsert(self, chat_id, **fields):
+        """
+        Create the subscription of the chat or update its fields
+        :param chat_id: (int) The ID of the Telegram chat
+        :param fields: values of the Subscription fields
+        :return: (tuple) (Subscription, set of names of the changed fields)
+        """
+        subscription = self._subscriptions.get(chat_id)
+        if subscription is None:
+            subscription = self._subscriptions[chat_id] = Subscription(chat_id, **fields)
+            changed = set(fields)
+        else:
+            self._unindex(subscription)
+            changed = set()
+            for name, value in fields.items():
+                if getattr(subscription, name) != value:
+                    setattr(subscription, name, value)
+                    changed.add(name)
+        self._index(subscription)
+        if changed and self.store is not None:
+            self.store.save_subscription(subscription)
+        return subscription, changed
+
+    def load(self, subscriptions):
+        """
+        Add the subscriptions read from the store
+        :param subscriptions: iterable of Subscription
+        :return: (int) number of loaded subscriptions
+        """
+        n_loaded = 0
+        for subscription in subscriptions:
+            previous = self._subscriptions.get(subscription.chat_id)
+            if previous is not None:
+                self._unindex(previous)
+            self._subscriptions[subscription.chat_id] = subscription
+            self._index(subscription)
+            n_loaded += 1
+        return n_loaded
+
+    def remove(self, chat_id, keep_stored=False):
+        """
+        Remove the subscription of the chat
+        :param chat_id: (int) The ID of the Telegram chat
+        :param keep_stored: bool, keep the subscription in the store, e.g. when another process delivers to the chat
+        :return: (Subscription) removed subscription or None
+        """
+        if self.store is not None and not keep_stored:
+            self.store.delete_subscription(chat_id)
+        subscription = self._subscriptions.pop(chat_id, None)
+        if subscription is not None:
+            self._unindex(subscription)
+        return subscription
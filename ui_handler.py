@@ -5,11 +5,15 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     MessageHandler,
-    PicklePersistence,
     filters,
 )
-from openweathermap_parser import OpenweathermapParser
-from weather_mailer import WeatherMailer
+from openweathermap_parser import AsyncOpenweathermapParser
+from delivery_pipeline import DeliveryPipeline
+from sharding import ShardPool
+from sqlite_persistence import SQLitePersistence
+from gazetteer import Gazetteer
+import metrics
+import httpx
 import re
 from logger import logger
 from dotenv import load_dotenv
@@ -17,33 +21,24 @@ load_dotenv()
 
 
 class UIHandler:
-    def __init__(self, bot_api_key, openweathermap_api_key):
-        self._bot_api_key = bot_api_key
-        self._openweathermap_api_key = openweathermap_api_key
+    def __init__(self, owmparser, mailer, gazetteer):
+        self.owmparser = owmparser
+        self.mailer = mailer
+        self.gazetteer = gazetteer
         self.CHOOSING, self.TYPING_REPLY, self.TYPING_CHOICE, self.PICK_LOCATION = range(4)
         self.reply_keyboard = [
             ["Location", "City", "Report time", "Alert time"],
             ["Done"],
         ]
         self.markup = ReplyKeyboardMarkup(self.reply_keyboard, one_time_keyboard=True)
-        self.wm = None
-        # self.user_data = {}
-        self._chat_id = None
-
-    def launch_mailer_bot(self, context):
-        """Launch the WeatherMailerBot"""
-        self.wm = WeatherMailer(city=context.user_data['city'],
-                                lat=context.user_data['lat'],
-                                lon=context.user_data['lon'],
-                                openweathermap_api_key=self._openweathermap_api_key,
-                                bot_api_key=self._bot_api_key,
-                                chat_id=self._chat_id)
-        self.wm.make_schedule(report_time=context.user_data['report time'],
-                              alert_time=context.user_data['alert time'])
 
-        # Start to run the schedule
-        self.wm.start_thread()
-        return
+    def launch_mailer_bot(self, chat_id, context):
+        """Subscribe the chat to the mailing or update its subscription with the user settings"""
+        self.mailer.subscribe(chat_id,
+                              lat=context.user_data['lat'],
+                              lon=context.user_data['lon'],
+                              report_time=context.user_data['report time'],
+                              alert_time=context.user_data['alert time'])
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Start the conversation, display any stored data and ask user for input."""
@@ -67,13 +62,12 @@ class UIHandler:
         await update.message.reply_text(reply_text, reply_markup=self.markup)
 
         # Start the MailerBot
-        self._chat_id = update.message.chat_id
-        self.launch_mailer_bot(context)
+        self.launch_mailer_bot(update.effective_chat.id, context)
         return self.CHOOSING
 
     async def stop(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Stop bot to send the wheather reports."""
-        self.wm.stop_thread()
+        self.mailer.unsubscribe(update.effective_chat.id)
         return await self.done(update, context)
 
     async def regular_choice(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -129,12 +123,21 @@ class UIHandler:
         return bool(time_re.match(s))
 
     async def _handle_city_input(self, category, text, update, context):
-        # Check if City name is relevant
-        owmparser = OpenweathermapParser(api_key=self._openweathermap_api_key)
-        response = owmparser.request_openweathermap_by_city(text)
-        response_dict = owmparser.parse_response_metadata(response)
-        if response_dict['cod'] == "401":
-            logger.error(response_dict['message'])
+        # Check if City name is relevant, known names are resolved without API call
+        response_dict = self.gazetteer.lookup_city(text)
+        if response_dict is None:
+            try:
+                response = await self.owmparser.request_openweathermap_by_city(text)
+                response_dict, forecast = self.owmparser.parse_response(response)
+            except httpx.HTTPError as e:
+                logger.error(f"Failed to request the city {text}: {e!r}")
+                response_dict = {'cod': None}
+            if response_dict['cod'] == "200":
+                self.gazetteer.remember_city(text, response_dict)
+                # The response carries the forecast of the city, it serves the first report
+                self.owmparser.forecast_cache.put(response_dict['lat'], response_dict['lon'], forecast)
+        if response_dict['cod'] not in ("200", "404"):
+            logger.error(f"Failed to request the city {text}, response code: {response_dict['cod']}")
             reply_text = "Sorry, technical problems"
             await update.message.reply_text(reply_text, reply_markup=self.markup)
             return self.CHOOSING
@@ -157,7 +160,7 @@ class UIHandler:
         await update.message.reply_text(reply_text, reply_markup=self.markup)
 
         # Update the settings in the MailerBot
-        self.wm.city = context.user_data['city']
+        self.launch_mailer_bot(update.effective_chat.id, context)
         return self.CHOOSING
 
     async def _handle_location_input(self, update, context, user_location):
@@ -165,19 +168,27 @@ class UIHandler:
         context.user_data['lon'] = user_location.longitude
         del context.user_data["choice"]
 
-        # Fetch city name
-        owmparser = OpenweathermapParser(api_key=self._openweathermap_api_key)
-        response = owmparser.request_openweathermap_by_latlon(context.user_data['lat'], context.user_data['lon'])
-        response_dict = owmparser.parse_response_metadata(response)
-        context.user_data['city'] = response_dict['city']
-        context.user_data['country'] = response_dict['country']
+        # Fetch city name, known locations are resolved without API call
+        response_dict = self.gazetteer.lookup_location(context.user_data['lat'], context.user_data['lon'])
+        if response_dict is None:
+            try:
+                response = await self.owmparser.request_openweathermap_by_latlon(context.user_data['lat'],
+                                                                                 context.user_data['lon'])
+                response_dict, forecast = self.owmparser.parse_response(response)
+            except httpx.HTTPError as e:
+                logger.error(f"Failed to request the location {user_location}: {e!r}")
+                response_dict = {'cod': None}
+            if response_dict['cod'] == "200":
+                self.gazetteer.remember_location(context.user_data['lat'], context.user_data['lon'], response_dict)
+                self.owmparser.forecast_cache.put(context.user_data['lat'], context.user_data['lon'], forecast)
+        context.user_data['city'] = response_dict.get('city', 'unknown')
+        context.user_data['country'] = response_dict.get('country', 'unknown')
 
         reply_text = self._get_update_settings_reply_text(context)
         await update.message.reply_text(reply_text, reply_markup=self.markup)
 
         # Update the settings in the MailerBot
-        self.wm.lat = context.user_data['lat']
-        self.wm.lon = context.user_data['lon']
+        self.launch_mailer_bot(update.effective_chat.id, context)
         return self.CHOOSING
 
     async def _handle_time_input(self, category, text, update, context):
@@ -193,8 +204,7 @@ class UIHandler:
         await update.message.reply_text(reply_text, reply_markup=self.markup)
 
         # Update the settings in the MailerBot
-        self.wm.make_schedule(report_time=context.user_data['report time'],
-                              alert_time=context.user_data['alert time'])
+        self.launch_mailer_bot(update.effective_chat.id, context)
         return self.CHOOSING
 
     @staticmethod
@@ -206,13 +216,59 @@ class UIHandler:
         return reply_text
 
 class UIBuilder:
-    def __init__(self, bot_api_key, openweathermap_api_key):
-        # Get setting of converstation handler
-        self.ui = UIHandler(bot_api_key, openweathermap_api_key)
+    # Seconds after the start before the render workers load the plotting stack, the bot answers first
+    render_warm_up_delay = 2.0
+    # Share of the openweathermap.org plan kept by the bot process for the lookups when the shards deliver
+    front_owm_share = 0.2
+    # File of PicklePersistence used by the earlier versions, imported into the empty database
+    pickle_path = "conversationbot"
+
+    def __init__(self, bot_api_key, openweathermap_api_key, metrics_port=None, bot_request=None,
+                 owm_transport=None, shards=0, db_path="conversationbot.sqlite3", owm_calls_per_minute=60):
+        """
+        :param bot_api_key: str, token of the Telegram bot
+        :param openweathermap_api_key: str, api_key for api.openweathermap.org
+        :param metrics_port: int, local port of the metrics and profiler endpoint (default=None, no endpoint)
+        :param bot_request: (telegram.request.BaseRequest) transport of the Bot API, e.g. a stand-in of Telegram
+         in the benchmarks (default=None, the network)
+        :param owm_transport: (httpx.AsyncBaseTransport) transport of the openweathermap.org client
+         (default=None, the network)
+        :param shards: int, number of the delivery shard processes, 0 to deliver in this process
+        :param db_path: str, path to the SQLite database of the bot state and the subscriptions
+        :param owm_calls_per_minute: (float) calls per minute of the openweathermap.org plan. With the shards
+         the bot process keeps front_owm_share of it for the city and location lookups, the shards share the rest
+        """
+        front_calls_per_minute = owm_calls_per_minute * self.front_owm_share if shards else owm_calls_per_minute
+        self.owmparser = AsyncOpenweathermapParser(api_key=openweathermap_api_key, transport=owm_transport,
+                                                   calls_per_minute=front_calls_per_minute)
 
         # Create the Application and pass it your bot's token.
-        self.persistence = PicklePersistence(filepath="conversationbot")
-        self.application = Application.builder().token(bot_api_key).persistence(self.persistence).build()
+        self.persistence = SQLitePersistence(filepath=db_path)
+        self.persistence.import_pickle(self.pickle_path)
+        builder = Application.builder().token(bot_api_key).persistence(self.persistence)\
+            .post_init(self._post_init).post_stop(self._post_stop).post_shutdown(self._post_shutdown)
+        if bot_request is not None:
+            builder = builder.request(bot_request).get_updates_request(bot_request)
+        elif not shards:
+            # The mailer sends through the same bot, so its connection pool is sized for the delivery workers
+            builder = builder.connection_pool_size(DeliveryPipeline.delivery_workers + 1)
+        self.application = builder.build()
+
+        # The deliveries run in this process or in the shard processes, the conversation always runs here
+        if shards:
+            self.pipeline = None
+            self.shard_pool = ShardPool(shards, bot_api_key, openweathermap_api_key, db_path,
+                                        forecast_cache=self.owmparser.forecast_cache,
+                                        owm_calls_per_minute=owm_calls_per_minute - front_calls_per_minute,
+                                        metrics_port=metrics_port, store=self.persistence)
+            mailer = self.shard_pool
+        else:
+            self.shard_pool = None
+            self.pipeline = DeliveryPipeline(self.application.bot, self.owmparser, self.persistence)
+            self.pipeline.register_metrics()
+            mailer = self.pipeline.mailer
+        self.ui = UIHandler(self.owmparser, mailer, Gazetteer())
+        self.metrics_server = metrics.MetricsServer(port=metrics_port) if metrics_port is not None else None
 
         # Add conversation handler with the states CHOOSING, TYPING_CHOICE and TYPING_REPLY
         self.conv_handler = ConversationHandler(
@@ -241,4 +297,30 @@ class UIBuilder:
             persistent=True,
         )
         self.application.add_handler(self.conv_handler)
-        pass
+
+    async def _post_init(self, application):
+        """Restore the subscriptions and start the delivery pipeline or the delivery shards"""
+        if self.pipeline is not None:
+            # The plotting stack is loaded by the render workers in the background, not before the polling starts
+            await self.pipeline.start(self.render_warm_up_delay)
+        else:
+            self.shard_pool.start()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+
+    async def _post_stop(self, application):
+        """
+        Stop the delivery and close the connections. It runs before Application.shutdown,
+        so the messages in flight are sent by the initialized bot and the subscriptions are written to the open store
+        """
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        if self.pipeline is not None:
+            await self.pipeline.stop()
+        else:
+            await self.shard_pool.stop()
+            await self.owmparser.aclose()
+
+    async def _post_shutdown(self, application):
+        """Close the database after the Application flushed it"""
+        self.persistence.close()
@@ -1,88 +1,231 @@
-import telebot
-import schedule
-from threading import Thread, Event
-from time import sleep
-from openweathermap_parser import OpenweathermapParser
-from plot_weather_graph import PlotBuilder
+import asyncio
+import os
+import time
+from functools import partial
+from alert_rules import AlertEngine
+from render_cache import RenderCache
+from subscriptions import SubscriptionRegistry, time_to_minute
 from logger import logger
 
 
 class WeatherMailer:
     """
-    Mailer of weather data via Telegram using the OpenWeatherMap API.
+    Mailer of weather data via Telegram using the OpenWeatherMap API to all the subscribed chats.
     """
-    def __init__(self, city, lat, lon, openweathermap_api_key, bot_api_key, chat_id):
+    # Plots shared by all the mailers, so each forecast is rendered and uploaded once
+    render_cache = RenderCache()
+    # Backend of PlotBuilder, 'fast' is about 20 times faster than matplotlib, its pixels differ a little
+    plot_backend = os.getenv('PLOT_BACKEND', 'matplotlib')
+
+    def __init__(self, owmparser, bot, scheduler, delivery_queue, render_pool, registry=None, alert_engine=None):
+        """
+        :param owmparser: (AsyncOpenweathermapParser) shared client of the OpenWeatherMap service
+        :param bot: (telegram.Bot) bot of the running Application
+        :param scheduler: (DeliveryScheduler) shared scheduler of the delivery jobs
+        :param delivery_queue: (DeliveryQueue) shared queue pacing the messages to Telegram
+        :param render_pool: (RenderPool) shared pool of the plot rendering processes
+        :param registry: (SubscriptionRegistry) subscriptions of the chats (default=empty registry)
+        :param alert_engine: (AlertEngine) rules of the rain alert (default=AlertEngine with the default rules)
+        """
+        self.owmparser = owmparser
+        self.bot = bot
+        self.scheduler = scheduler
+        self.delivery_queue = delivery_queue
+        self.render_pool = render_pool
+        self.registry = registry if registry is not None else SubscriptionRegistry()
+        self.alert_engine = alert_engine if alert_engine is not None else AlertEngine()
+        self._background_tasks = set()
+
+    def subscribe(self, chat_id, lat, lon, report_time, alert_time, tz_offset=None):
         """
-        :param city: str, the name of the city for which weather data will be retrieved.
-        :param openweathermap_api_key: str, The API key for the OpenWeatherMap service
-        :param bot_api_key: str, The API key for the Telegram bot
+        Create or update the subscription of the chat, only the changed jobs are rescheduled.
+        The times are in the local time of the location, its UTC offset is taken from the forecasts.
         :param chat_id: The ID of the Telegram chat where weather data will be sent
+        :param lat: (float) latitude
+        :param lon: (float) longitude
+        :param report_time: str, time of weather report e.g. "08:00"
+        :param alert_time: str, time of rain alert e.g. "08:30"
+        :param tz_offset: (int) shift of the location time zone from UTC in seconds if it is known
+         (default=None, taken from the cached forecast of the location or requested)
+        """
+        fields = {'lat': lat, 'lon': lon, 'report_minute': time_to_minute(report_time),
+                  'alert_minute': time_to_minute(alert_time)}
+        if tz_offset is None:
+            forecast = self.owmparser.forecast_cache.get_stale(lat, lon)
+            if forecast is not None:
+                tz_offset = forecast.timezone
+        if tz_offset is not None:
+            fields['tz_offset'] = tz_offset
+        self._upsert(chat_id, **fields)
+        if tz_offset is None:
+            # Learn the UTC offset of the new location before its first delivery
+            task = asyncio.get_running_loop().create_task(self.update_timezone(chat_id))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+
+    def unsubscribe(self, chat_id, keep_stored=False):
         """
-        self.city = city
-        self.lat = lat
-        self.lon = lon
-        self.openweathermap_api_key = openweathermap_api_key
-        self.bot = telebot.TeleBot(bot_api_key)
-        self.chat_id = chat_id
-        self.weather_dict = None
-        self.plot_path = None
-        self.scheduler = schedule.Scheduler()
-        self._thread = Thread(target=self.schedule_checker)
-        self._stop_flag = Event()
+        Remove the subscription and the jobs of the chat
+        :param chat_id: The ID of the subscribed Telegram chat
+        :param keep_stored: bool, keep the subscription in the store, e.g. when it moves to another delivery shard
+        """
+        logger.info(f'Stopping the mailing to chat {chat_id}')
+        subscription = self.registry.remove(chat_id, keep_stored=keep_stored)
+        self.scheduler.cancel((chat_id, 'report'))
+        if subscription is not None:
+            self._release_alert_minute(subscription.alert_utc_minute)
+
+    async def update_timezone(self, chat_id):
+        """
+        Request the forecast of the location of the chat and update the UTC offset of its subscription
+        :param chat_id: The ID of the subscribed Telegram chat
+        """
+        subscription = self.registry.get(chat_id)
+        if subscription is None:
+            return
+        forecast = await self.owmparser.get_weather_dict(subscription.lat, subscription.lon)
+        if forecast is not None:
+            self._apply_timezone(subscription, forecast)
 
-    def send_weather_forecast(self):
+    async def send_weather_forecast(self, chat_id):
         """
         Request weather from openweathermap.org and send the report
+        :param chat_id: The ID of the subscribed Telegram chat
         """
+        subscription = self.registry.get(chat_id)
+        if subscription is None:
+            return
         # Get weather forecast and build plot
-        owmparser = OpenweathermapParser(api_key=self.openweathermap_api_key)
-        self.weather_dict = owmparser.get_weather_dict(self.lat, self.lon)
+        forecast = await self.owmparser.get_weather_dict(subscription.lat, subscription.lon)
+        if forecast is None:
+            logger.error("No weather forecast to send to chat %d", chat_id)
+            return
+        self._apply_timezone(subscription, forecast)
+
+        plot = await self.render_cache.get_or_render_async(
+            forecast, lambda: self.render_pool.render_png(forecast, self.plot_backend))
 
-        self.plot_path = PlotBuilder(self.weather_dict).plot_weather_ts()
-        with open(self.plot_path, 'rb') as f:
-            self.bot.send_photo(self.chat_id, f, caption="Have a nice day!", disable_notification=True)
+        async def send():
+            message = await self.bot.send_photo(chat_id=chat_id, photo=plot.photo,
+                                                caption="Have a nice day!", disable_notification=True)
+            self.render_cache.remember_file_id(plot, message.photo[-1].file_id)
+        self.delivery_queue.submit(chat_id, send)
 
-    def alert_umbrella(self):
+    async def prefetch(self, lat, lon, min_ttl=0, render=True):
+        """
+        Warm the forecast and plot caches for the location ahead of the deliveries
+        :param lat: (float) latitude
+        :param lon: (float) longitude
+        :param min_ttl: (float) seconds the cached forecast has to stay fresh, otherwise it is refreshed
+        :param render: bool, render the plot of the forecast too
+        :return: bool, if the forecast is in the cache
+        """
+        if self.owmparser.forecast_cache.expires_in(lat, lon) > min_ttl:
+            forecast = await self.owmparser.get_weather_dict(lat, lon)
+        else:
+            forecast = await self.owmparser.refresh_weather_dict(lat, lon)
+        if forecast is None:
+            return False
+        if render:
+            await self.render_cache.get_or_render_async(
+                forecast, lambda: self.render_pool.render_png(forecast, self.plot_backend))
+        return True
+
+    async def alert_umbrella(self, chat_id):
         """
         Send alert if rain is going to be
+        :param chat_id: The ID of the subscribed Telegram chat
         """
-        try:
-            if any(w in self.weather_dict['main'] for w in ["Rain", "Thunderstorm", "Drizzle"]):
-                self.bot.send_message(self.chat_id,
-                                      "☔️☂️Looks like it's going to rain today, don't forget to bring an umbrella!",
-                                      disable_notification=False)
-        except KeyError as e:
-            logger.error({e})
+        await self.send_alerts([chat_id])
 
-    def make_schedule(self, report_time, alert_time):
+    async def send_alerts_due_at(self, minute_of_day):
         """
-        Makes a schedule to send message
-        :param report_time: str, time of weather report e.g. "08:00"
-        :param alert_time: str, time of rain alert e.g. "08:30"
+        Send the rain alert to the chats with the alert at the UTC minute of the day
+        :param minute_of_day: (int) e.g. 510 for "08:30" UTC
         """
-        self.scheduler.clear()
-        self.scheduler.every().day.at(report_time).do(self.send_weather_forecast)
-        self.scheduler.every().day.at(alert_time).do(self.alert_umbrella)
-        # self.scheduler.every(10).seconds.do(self.send_weather_forecast)
-        # self.scheduler.every(10).seconds.do(self.alert_umbrella)
+        await self.send_alerts(self.registry.chat_ids_due_at(minute_of_day, 'alert'))
 
-    def schedule_checker(self, time_step=1):
+    async def send_alerts(self, chat_ids):
         """
-        Checks the `schedule` library for pending jobs.
+        Evaluate the alert rules for the chats in one batch and send the alert to the chats which need it.
+        Each distinct location is requested once.
+        :param chat_ids: list of the IDs of the subscribed Telegram chats
         """
-        while not self._stop_flag.is_set():
-            self.scheduler.run_pending()
-            sleep(time_step)
+        cache = self.owmparser.forecast_cache
+        chat_locations = {}
+        locations = {}
+        for chat_id in chat_ids:
+            subscription = self.registry.get(chat_id)
+            if subscription is None:
+                continue
+            cell = cache.cell(subscription.lat, subscription.lon)
+            chat_locations[chat_id] = cell
+            locations.setdefault(cell, (subscription.lat, subscription.lon))
+        # The forecasts of the reports and the prefetcher are normally still in the forecast cache
+        results = await asyncio.gather(*(self.owmparser.get_weather_dict(lat, lon)
+                                         for lat, lon in locations.values()))
+        forecasts = {cell: forecast for cell, forecast in zip(locations, results) if forecast is not None}
+        if len(forecasts) < len(locations):
+            logger.error("No weather forecast to check the rain at %d locations", len(locations) - len(forecasts))
+        for chat_id, cell in chat_locations.items():
+            if cell in forecasts:
+                self._apply_timezone(self.registry.get(chat_id), forecasts[cell])
+        for chat_id in self.alert_engine.chat_ids_to_alert(chat_locations, forecasts, int(time.time())):
+            self.delivery_queue.submit(chat_id, partial(
+                self.bot.send_message, chat_id=chat_id,
+                text="☔️☂️Looks like it's going to rain today, don't forget to bring an umbrella!",
+                disable_notification=False))
 
-    def start_thread(self):
-        """Start thread"""
-        logger.info('Starting thread')
-        self._thread.start()
+    def make_schedule(self, chat_id, report_time, alert_time):
+        """
+        Makes a schedule to send message, the jobs with unchanged time are kept.
+        The chat has to be subscribed, its location is set by subscribe
+        :param chat_id: The ID of the subscribed Telegram chat
+        :param report_time: str, time of weather report e.g. "08:00"
+        :param alert_time: str, time of rain alert e.g. "08:30"
+        """
+        if self.registry.get(chat_id) is None:
+            raise LookupError(f"Chat {chat_id} has no subscription to schedule, subscribe it with its location")
+        self._upsert(chat_id, report_minute=time_to_minute(report_time), alert_minute=time_to_minute(alert_time))
+
+    def reschedule_all(self):
+        """Add the jobs of all the subscriptions of the registry to the scheduler, e.g. after a restart"""
+        for subscription in self.registry:
+            self._schedule_jobs(subscription, changed=())
 
-    def stop_thread(self):
-        """Stop runnning thread"""
-        if self._thread.is_alive():
-            logger.info('Stopping thread')
-            self._stop_flag.set()
-            self._thread.join()
+    def _upsert(self, chat_id, **fields):
+        """Update the subscription in the registry and reschedule its jobs"""
+        previous = self.registry.get(chat_id)
+        previous_alert_minute = previous.alert_utc_minute if previous is not None else None
+        subscription, changed = self.registry.upsert(chat_id, **fields)
+        self._schedule_jobs(subscription, changed)
+        if previous_alert_minute not in (None, subscription.alert_utc_minute):
+            self._release_alert_minute(previous_alert_minute)
+
+    def _apply_timezone(self, subscription, forecast):
+        """Reschedule the jobs of the subscription if the UTC offset of its location changed, e.g. with DST"""
+        # The chat may be unsubscribed while its forecast was requested, it is not subscribed again
+        if subscription is None or self.registry.get(subscription.chat_id) is not subscription:
             return
+        if subscription.tz_offset != forecast.timezone:
+            logger.info("UTC offset of chat %d is %d s", subscription.chat_id, forecast.timezone)
+            self._upsert(subscription.chat_id, tz_offset=forecast.timezone)
+
+    def _schedule_jobs(self, subscription, changed):
+        """
+        Add the jobs of the subscription which are missing or whose time is changed.
+        The reports are sent by a job per chat, the alerts by a job per UTC minute of the day shared by the chats.
+        """
+        chat_id = subscription.chat_id
+        if {'report_minute', 'tz_offset'} & set(changed) or (chat_id, 'report') not in self.scheduler:
+            self.scheduler.every_day_at((chat_id, 'report'), subscription.report_utc_minute,
+                                        partial(self.send_weather_forecast, chat_id))
+        alert_minute = subscription.alert_utc_minute
+        if ('alert', alert_minute) not in self.scheduler:
+            self.scheduler.every_day_at(('alert', alert_minute), alert_minute,
+                                        partial(self.send_alerts_due_at, alert_minute))
+
+    def _release_alert_minute(self, minute_of_day):
+        """Cancel the alert job of the UTC minute of the day if no chat has the alert at it"""
+        if not self.registry.chat_ids_due_at(minute_of_day, 'alert'):
+            self.scheduler.cancel(('alert', minute_of_day))